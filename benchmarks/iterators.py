@@ -0,0 +1,68 @@
+import os
+import multiprocessing as mp
+
+import cv2
+
+from .synthetic_data import make_images, make_arrays, make_labels
+from .timing import measure_iterator, run_case
+
+from package.data_iterators.iterators.base_iterator import BaseIterator
+from package.data_iterators.iterators.multiprocess_iterator import MultiProcessIterator
+from package.data_iterators.iterators.thread_pool_iterator import ThreadPoolIterator
+from package.data_iterators.samplers.ohc_balancer import OHCBalancer
+from package.data_iterators.preprocessors.base_preprocessor import ArrayReader, IdentityPreprocessor
+from package.data_iterators.preprocessors.image_preprocessor import RGBImageFromFile
+
+IMAGE_SIZE = (112, 112)
+ARRAY_SHAPE = (16, 112, 112, 3)
+NUM_CLASSES = 10
+
+
+def _resize(img):
+    return cv2.resize(img, IMAGE_SIZE[::-1])
+
+
+def _workloads(data_dir, num_samples):
+    labels = make_labels(num_samples, NUM_CLASSES)
+    image_paths = make_images(os.path.join(data_dir, 'images'), num_samples)
+    format_string, _ = make_arrays(os.path.join(data_dir, 'arrays'), num_samples, shape=ARRAY_SHAPE)
+
+    return {
+        'jpeg': (labels, {'image': image_paths, 'label': labels}, lambda: {
+            'image': RGBImageFromFile(name='image', shape=(3,) + IMAGE_SIZE, image_transformer=_resize),
+            'label': IdentityPreprocessor(name='label', shape=(NUM_CLASSES,))
+        }),
+        'npy': (labels, {'array': list(range(num_samples)), 'label': labels}, lambda: {
+            'array': ArrayReader(name='array', shape=ARRAY_SHAPE, format_string=format_string),
+            'label': IdentityPreprocessor(name='label', shape=(NUM_CLASSES,))
+        })
+    }
+
+
+def _configs(num_workers):
+    return [
+        ('BaseIterator', BaseIterator, {}),
+        ('MultiProcessIterator', MultiProcessIterator, {'num_processes': num_workers}),
+        ('MultiProcessIterator(use_shared)', MultiProcessIterator, {'num_processes': num_workers, 'use_shared': True}),
+        ('ThreadPoolIterator', ThreadPoolIterator, {'num_threads': num_workers}),
+    ]
+
+
+def run(data_dir, quick=False, batch_size=32, num_workers=None):
+    num_samples = 256 if quick else 2048
+    num_workers = num_workers or min(4, mp.cpu_count())
+
+    results = []
+    for workload, (labels, data, make_preprocessors) in sorted(_workloads(data_dir, num_samples).items()):
+        packers = {name: 'numpy' for name in data}
+        for name, iterator_cls, kwargs in _configs(num_workers):
+            def make_iterator():
+                return iterator_cls(
+                    balancer=OHCBalancer(data=labels, raise_on_end=True), data=data,
+                    preprocessors=make_preprocessors(), packers=packers, batch_size=batch_size,
+                    return_indices=True, **kwargs
+                )
+
+            params = dict(kwargs, workload=workload, num_samples=num_samples, batch_size=batch_size)
+            results.append(run_case('iterators', name, params, lambda: measure_iterator(make_iterator)))
+    return results
@@ -0,0 +1,73 @@
+"""
+Runs benchmarks on locally generated synthetic data and saves results as JSON:
+
+    python -m benchmarks.run_benchmarks --out results.json [--quick] [--suites iterators samplers]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import shutil
+import platform
+import tempfile
+import subprocess
+import multiprocessing as mp
+
+import numpy as np
+
+from . import iterators, samplers, transformers, video
+
+SUITES = {'iterators': iterators, 'samplers': samplers, 'transformers': transformers, 'video': video}
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': commit, 'python': sys.version.split()[0],
+        'numpy': np.__version__, 'platform': platform.platform(), 'cpu_count': mp.cpu_count()
+    }
+
+
+def summary_line(record):
+    if 'error' in record or 'skipped' in record:
+        return '{suite:>12} {name:<40} {status}'.format(
+            status='ERROR ' + record['error'] if 'error' in record else 'skipped: ' + record['skipped'], **record)
+
+    params = ', '.join('{}={}'.format(k, v) for k, v in sorted(record['params'].items()))
+    rate = ' {:10.1f} samples/s'.format(record['samples_per_second']) if 'samples_per_second' in record else ''
+    return '{:>12} {:<40} p50 {:10.6f}s{} ({})'.format(
+        record['suite'], record['name'], record['latency']['p50'], rate, params)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--out', default='benchmark_results.json', help='path of JSON with results')
+    parser.add_argument('--suites', nargs='+', choices=sorted(SUITES), default=sorted(SUITES))
+    parser.add_argument('--quick', action='store_true', help='smaller data and fewer repeats')
+    parser.add_argument('--data-dir', default=None, help='directory for synthetic data, temporary by default')
+    args = parser.parse_args()
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='dp_utils_bench_')
+    results = []
+    for suite in args.suites:
+        np.random.seed(0)
+        for record in SUITES[suite].run(os.path.join(data_dir, suite), quick=args.quick):
+            print(summary_line(record))
+            sys.stdout.flush()
+            results.append(record)
+
+    with open(args.out, 'w') as f:
+        json.dump({'environment': environment(), 'quick': args.quick, 'results': results}, f, indent=2)
+    if args.data_dir is None:
+        shutil.rmtree(data_dir)
+    print('Results are saved to {}'.format(args.out))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+import numpy as np
+
+from .synthetic_data import make_labels
+from .timing import measure_calls, run_case
+
+from package.data_iterators.samplers.base_balancer import BaseBalancer
+from package.data_iterators.samplers.basket_balancer import BasketBalancer
+from package.data_iterators.samplers.merged_balancer import MergedBalancer
+from package.data_iterators.samplers.ohc_balancer import OHCBalancer
+from package.data_iterators.samplers.sequence_balancer import SequenceBalancer
+from package.data_iterators.samplers.softmax_balancer import SoftmaxBalancer
+
+NUM_CLASSES = 10
+
+
+def _balancers(num_samples):
+    labels = make_labels(num_samples, NUM_CLASSES)
+    soft_labels = labels + np.random.RandomState(0).uniform(0, 0.5, labels.shape)
+    baskets = np.random.RandomState(0).randint(0, NUM_CLASSES, num_samples)
+    index = np.arange(num_samples)
+
+    return [
+        ('BaseBalancer', lambda: BaseBalancer(index, raise_on_end=False)),
+        ('OHCBalancer', lambda: OHCBalancer(labels, raise_on_end=False)),
+        ('SoftmaxBalancer', lambda: SoftmaxBalancer(soft_labels, raise_on_end=False)),
+        ('BasketBalancer', lambda: BasketBalancer(index, baskets, raise_on_data_end=False,
+                                                  raise_on_basket_end=False)),
+        ('SequenceBalancer', lambda: SequenceBalancer(BaseBalancer(index, raise_on_end=False), sequence_len=3)),
+        ('MergedBalancer', lambda: MergedBalancer([BaseBalancer(index, raise_on_end=False),
+                                                   OHCBalancer(labels, raise_on_end=False)])),
+    ]
+
+
+def run(data_dir, quick=False):
+    num_samples = 10000 if quick else 100000
+    repeat, number = (5, 200) if quick else (20, 1000)
+
+    results = []
+    for name, make_balancer in _balancers(num_samples):
+        def measure():
+            np.random.seed(0)
+            balancer = make_balancer()
+            return measure_calls(balancer.next, repeat=repeat, number=number)
+
+        params = {'num_samples': num_samples, 'num_classes': NUM_CLASSES}
+        results.append(run_case('samplers', '{}.next'.format(name), params, measure))
+    return results
@@ -0,0 +1,88 @@
+import os
+
+import cv2
+import numpy as np
+
+
+def make_images(out_dir, num_images, size=(240, 320), seed=0):
+    """
+    Writes random JPEG images with a few color blocks, so that they are compressed like natural ones
+    :param size: h, w
+    :return: list of paths
+    """
+    rng = np.random.RandomState(seed)
+    os.makedirs(out_dir, exist_ok=True)
+
+    paths = []
+    for num in range(num_images):
+        img = np.full(size + (3,), rng.randint(0, 256, 3), dtype=np.uint8)
+        for _ in range(8):
+            y, x = rng.randint(0, size[0]), rng.randint(0, size[1])
+            img[y:y + size[0] // 4, x:x + size[1] // 4] = rng.randint(0, 256, 3)
+        img = cv2.add(img, rng.randint(0, 16, img.shape).astype(np.uint8))
+
+        path = os.path.join(out_dir, 'img_{:05d}.jpg'.format(num))
+        cv2.imwrite(path, img)
+        paths.append(path)
+    return paths
+
+
+def make_arrays(out_dir, num_arrays, shape=(16, 112, 112, 3), seed=0):
+    """
+    Writes random uint8 arrays as .npy files
+    :return: format string for ArrayReader-like preprocessors and list of paths
+    """
+    rng = np.random.RandomState(seed)
+    os.makedirs(out_dir, exist_ok=True)
+
+    format_string = os.path.join(out_dir, 'arr_{}.npy')
+    paths = []
+    for num in range(num_arrays):
+        path = format_string.format(num)
+        np.save(path, rng.randint(0, 256, shape).astype(np.uint8))
+        paths.append(path)
+    return format_string, paths
+
+
+def make_videos(out_dir, num_videos, num_frames=50, size=(240, 320), fps=25, seed=0):
+    """
+    Writes short MJPG videos with a moving block
+    :return: list of paths, empty if opencv cannot write videos
+    """
+    rng = np.random.RandomState(seed)
+    os.makedirs(out_dir, exist_ok=True)
+
+    paths = []
+    for num in range(num_videos):
+        path = os.path.join(out_dir, 'video_{:03d}.avi'.format(num))
+        writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), fps, (size[1], size[0]))
+        if not writer.isOpened():
+            return []
+
+        background = rng.randint(0, 256, 3)
+        for frame_num in range(num_frames):
+            frame = np.full(size + (3,), background, dtype=np.uint8)
+            x = frame_num * size[1] // num_frames
+            frame[size[0] // 3:2 * size[0] // 3, x:x + size[1] // 5] = 255
+            writer.write(frame)
+        writer.release()
+        paths.append(path)
+    return paths
+
+
+def make_boxes(num_boxes, seed=0):
+    """
+    :return: (num_boxes, 4) array of valid boxes in relative xyxy coordinates
+    """
+    rng = np.random.RandomState(seed)
+    tops = rng.uniform(0, 0.8, (num_boxes, 2))
+    sizes = rng.uniform(0.05, 0.2, (num_boxes, 2))
+    return np.concatenate([tops, tops + sizes], axis=1)
+
+
+def make_labels(num_samples, num_classes, seed=0):
+    """
+    :return: (num_samples, num_classes) one hot encoded labels
+    """
+    rng = np.random.RandomState(seed)
+    return np.eye(num_classes)[rng.randint(0, num_classes, num_samples)]
@@ -0,0 +1,83 @@
+import time
+import traceback
+
+import numpy as np
+
+
+def latency_stats(durations):
+    """
+    :param durations: seconds of every call
+    :return: dict of statistics of durations in seconds
+    """
+    durations = np.asarray(durations, dtype=float)
+    return {
+        'count': len(durations), 'mean': float(durations.mean()), 'std': float(durations.std()),
+        'min': float(durations.min()), 'p50': float(np.percentile(durations, 50)),
+        'p90': float(np.percentile(durations, 90)), 'max': float(durations.max())
+    }
+
+
+def measure_calls(func, repeat=20, warmup=2, number=1):
+    """
+    Times func(), which is called number times per measurement, after warmup calls
+    :return: dict with latency statistics of one call
+    """
+    for _ in range(warmup):
+        func()
+
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        durations.append((time.perf_counter() - start) / number)
+    return {'latency': latency_stats(durations)}
+
+
+def measure_iterator(make_iterator, num_epochs=1):
+    """
+    Iterates through epochs of iterator made by make_iterator(), epoch ends with StopIteration
+    :return: dict with samples per second, time to the first batch and latency of next
+    """
+    start = time.perf_counter()
+    iterator = make_iterator()
+    setup_time = time.perf_counter() - start
+
+    durations, num_samples, first_batch = [], 0, None
+    start = time.perf_counter()
+    for epoch in range(num_epochs):
+        if epoch != 0:
+            iterator.reset()
+        while True:
+            batch_start = time.perf_counter()
+            try:
+                batch = iterator.next()
+            except StopIteration:
+                break
+            durations.append(time.perf_counter() - batch_start)
+            first_batch = first_batch or time.perf_counter() - start
+            num_samples += len(batch[-1]) if iterator.return_indices else len(batch[0])
+    total = time.perf_counter() - start
+
+    result = {
+        'samples': num_samples, 'seconds': total, 'samples_per_second': num_samples / total,
+        'setup_seconds': setup_time, 'first_batch_seconds': first_batch, 'latency': latency_stats(durations)
+    }
+    close = getattr(iterator, 'close', None)
+    if close is not None:
+        close()
+    return result
+
+
+def run_case(suite, name, params, measure):
+    """
+    Runs measure(), errors are recorded instead of stopping the suite
+    :return: result record
+    """
+    record = {'suite': suite, 'name': name, 'params': params}
+    try:
+        record.update(measure())
+    except Exception as e:
+        record['error'] = '{}: {}'.format(type(e).__name__, e)
+        record['traceback'] = traceback.format_exc()
+    return record
@@ -0,0 +1,59 @@
+import numpy as np
+
+from .synthetic_data import make_boxes
+from .timing import measure_calls, run_case
+
+from package.transformers.bbox import random_crop_with_constraints
+from package.transformers.iou import diag_iou, full_iou
+from package.transformers.normalization import normalize_transpose
+from package.transformers.resizing import resize_frames
+
+
+def run(data_dir, quick=False):
+    repeat = 5 if quick else 20
+    results = []
+
+    for num_boxes in (10, 100, 1000):
+        boxes1, boxes2 = make_boxes(num_boxes, seed=0), make_boxes(num_boxes, seed=1)
+        results.append(run_case('transformers', 'full_iou', {'num_boxes': num_boxes},
+                                lambda: measure_calls(lambda: full_iou(boxes1, boxes2), repeat=repeat, number=10)))
+
+    for num_boxes in (100, 10000, 1000000):
+        boxes1, boxes2 = make_boxes(num_boxes, seed=0), make_boxes(num_boxes, seed=1)
+        results.append(run_case('transformers', 'diag_iou', {'num_boxes': num_boxes},
+                                lambda: measure_calls(lambda: diag_iou(boxes1, boxes2), repeat=repeat, number=10)))
+
+    for num_boxes in (1, 10, 50):
+        boxes, labels = make_boxes(num_boxes), np.arange(num_boxes)[:, None]
+
+        def crop():
+            return random_crop_with_constraints(boxes, labels, size=(480, 640), min_size_px=8,
+                                                target_shape=(300, 300), max_trial=50)
+
+        def measure():
+            np.random.seed(0)
+            return measure_calls(crop, repeat=repeat, number=20)
+
+        results.append(run_case('transformers', 'random_crop_with_constraints',
+                                {'num_boxes': num_boxes, 'max_trial': 50}, measure))
+
+    frames = np.random.RandomState(0).randint(0, 256, (16, 240, 320, 3)).astype(np.uint8)
+    for keep_aspect_ratio in (False, True):
+        def resize():
+            return resize_frames(frames, (112, 112), keep_aspect_ratio=keep_aspect_ratio)
+
+        params = {'frames_shape': list(frames.shape), 'target_size': [112, 112], 'keep_aspect_ratio': keep_aspect_ratio}
+        results.append(run_case('transformers', 'resize_frames', params,
+                                lambda: measure_calls(resize, repeat=repeat, number=5)))
+
+    mean, std = np.array([123.7, 116.3, 103.5]), np.array([58.4, 57.1, 57.4])
+    for dtype in (np.float32, np.float16):
+        out = np.empty((3,) + frames.shape[:3], dtype=dtype)
+        params = {'frames_shape': list(frames.shape), 'layout': 'CTHW', 'dtype': np.dtype(dtype).name}
+        results.append(run_case('transformers', 'normalize_transpose', params, lambda: measure_calls(
+            lambda: normalize_transpose(frames, mean, std, (3, 0, 1, 2), out=out), repeat=repeat, number=5)))
+    results.append(run_case('transformers', 'normalize_transpose_float64_reference',
+                            {'frames_shape': list(frames.shape), 'layout': 'CTHW', 'dtype': 'float64'},
+                            lambda: measure_calls(lambda: np.ascontiguousarray(
+                                ((frames - mean) / std).transpose(3, 0, 1, 2)), repeat=repeat, number=5)))
+    return results
@@ -0,0 +1,34 @@
+import os
+import shutil
+
+from .synthetic_data import make_videos
+from .timing import measure_calls, run_case
+
+NUM_FRAMES, FPS = 50, 25
+
+
+def run(data_dir, quick=False):
+    params = {'num_frames': NUM_FRAMES, 'fps': FPS, 'size': [240, 320]}
+    try:
+        from package.io.video_reading import frame_array_from_video
+    except ImportError as e:
+        return [{'suite': 'video', 'name': 'frame_array_from_video', 'params': params, 'skipped': str(e)}]
+    if shutil.which('ffmpeg') is None:
+        return [{'suite': 'video', 'name': 'frame_array_from_video', 'params': params, 'skipped': 'no ffmpeg'}]
+
+    paths = make_videos(os.path.join(data_dir, 'videos'), 2 if quick else 8, num_frames=NUM_FRAMES, fps=FPS)
+    if len(paths) == 0:
+        return [{'suite': 'video', 'name': 'frame_array_from_video', 'params': params,
+                 'skipped': 'opencv cannot write videos'}]
+
+    results = []
+    duration = NUM_FRAMES / float(FPS)
+    for ts_start, ts_end in ((0., duration), (duration / 2, duration / 2 + 0.4)):
+        def read():
+            for path in paths:
+                frame_array_from_video(path, ts_start=ts_start, ts_end=ts_end)
+
+        results.append(run_case('video', 'frame_array_from_video',
+                                dict(params, ts_start=ts_start, ts_end=ts_end, num_videos=len(paths)),
+                                lambda: measure_calls(read, repeat=3 if quick else 10, warmup=1)))
+    return results
@@ -1,7 +1,10 @@
+import time
 import numpy as np
 import logging
-from collections import defaultdict
+from contextlib import nullcontext
 
+from ...routines.metrics_routines import Metrics
+from ...routines.random_routines import derive_seed, seeded_random_state
 from ... import ROOT_LOGGER_NAME, ROOT_LOGGER_LEVEL
 logger = logging.getLogger('{}.{}'.format(ROOT_LOGGER_NAME, __name__))
 logger.setLevel(ROOT_LOGGER_LEVEL)
@@ -14,12 +17,25 @@ class BaseIterator(object):
     }
 
     def __init__(self, balancer, data, preprocessors, packers=None,
-                 batch_size=32, num_batches=None, return_indices=False):
+                 batch_size=32, num_batches=None, return_indices=False,
+                 preallocate=False, reuse_buffers=False, batch_process=False, seed=None, collect_metrics=True):
         """
         :param data: dict {data_name: iterable ...}
         :param balancer: instance of balancer
         :param preprocessors: dict {(names | name: preprocessor)}
         :param packers: dict {name: 'mxnet' | 'numpy' | 'list'}
+        :param preallocate: write every sample of 'numpy' packed data straight into its row of a contiguous
+                            batch array instead of collecting a list and calling np.array on it
+        :param reuse_buffers: with preallocate, keep the same batch arrays between batches,
+                              returned arrays are views valid only until the next call of next,
+                              otherwise a fresh array is allocated per batch and handed over to the caller
+        :param batch_process: call process_batch of preprocessors on several samples at once,
+                              falling back to per sample processing if some sample of the batch fails
+        :param seed: if set, every sample is processed with global random state seeded from (seed, epoch, index),
+                     so augmentations do not depend on processing order, epoch is incremented by reset,
+                     samples are processed one by one then
+        :param collect_metrics: time balancer, preprocessors and packing, see metrics,
+                                counters of batches, samples and failures are collected anyway
         """
         self._return_indices = return_indices
         self._balancer = balancer
@@ -31,14 +47,38 @@ class BaseIterator(object):
         self._num_batches = num_batches
         self._batch_counter = 0
 
-        self._packers = packers or {name: 'mxnet' for name, shape in self.provide_data}
+        self._provided = list(self.provide_data)
+        self._packers = packers or {name: 'mxnet' for name, shape in self._provided}
         self._check_packers()
 
+        self._preallocate = preallocate
+        self._reuse_buffers = reuse_buffers
+        self._buffered_names = {name for name, _ in self._provided if self._packers[name] == 'numpy'} \
+            if preallocate else set()
+        self._buffers = {}
+        self._finalized_buffers = {}
+        self._finalizers = {name: processor for processor in self._preprocessors.values()
+                            if hasattr(processor, 'finalize_batch') for name, _ in processor.provide_data}
+
+        self._batch_process = batch_process
+        self._seed = seed
+        self._epoch = 0
+        self._input_names = sorted({k for processor in self._preprocessors.values()
+                                    for k in processor.provide_input})
+
+        self._collect_metrics = collect_metrics
+        self._metrics = Metrics()
+        self._metric_names = {name: 'process/{}'.format(name) for name in self._preprocessors}
+        # (metric name, process, input names) of preprocessors, looked up once instead of for every sample
+        self._process_calls = [(self._metric_names[name], processor.process, tuple(processor.provide_input))
+                               for name, processor in self._preprocessors.items()]
+
     def __iter__(self):
         return self
 
     def reset(self):
         self._balancer.reset()
+        self._epoch += 1
 
     def add_batch_size(self, provide_product):
         return provide_product[0], (self._batch_size,) + provide_product[1]
@@ -64,42 +104,257 @@ class BaseIterator(object):
             for provided in processor.provide_data
         ]
 
+    @property
+    def metrics(self):
+        """
+        :return: dict snapshot of metrics (see Metrics.snapshot) with samples_per_second,
+                 latencies of preprocessors are under 'process/<name>', of nodes of composite ones
+                 under 'process/<name>/<node name>', latencies of preprocessors and balancer are
+                 added as means of chunks (of batches for single samples), so their quantiles are the ones of means
+        """
+        collected = Metrics()
+        collected.merge(self._metrics)
+        for name, metrics in self._preprocessor_metrics():
+            collected.merge(metrics, prefix='{}/'.format(self._metric_names[name]))
+
+        snapshot = collected.snapshot()
+        snapshot['elapsed'] = self._metrics.elapsed
+        snapshot['samples_per_second'] = snapshot['counters'].get('samples', 0) / snapshot['elapsed']
+        return snapshot
+
+    def reset_metrics(self):
+        self._metrics.reset()
+        for _, metrics in self._preprocessor_metrics():
+            metrics.reset()
+
+    def _preprocessor_metrics(self):
+        return [(name, processor.metrics) for name, processor in self._preprocessors.items()
+                if isinstance(getattr(processor, 'metrics', None), Metrics)]
+
     def _check_packers(self):
         if 'mxnet' in self._packers.values():
             logger.warning('if mxnet packer is set for at least one kind of data, it must be set for every')
 
+    def _gather(self, key, indices):
+        data = self._data[key]
+        if isinstance(data, np.ndarray):
+            return data[np.asarray(indices)]
+        return [data[idx] for idx in indices]
+
+    @staticmethod
+    def _add_timing(timings, name, duration):
+        timing = timings.get(name)
+        if timing is None:
+            timings[name] = [duration, 1]
+        else:
+            timing[0] += duration
+            timing[1] += 1
+
+    def _add_timings(self, timings):
+        # mean latencies of chunks are added to histograms with number of samples, so that count and total are exact
+        for name, (total, num) in timings.items():
+            self._metrics.add(name, total / num, count=num)
+
+    def _next_index(self, timings=None):
+        """
+        :param timings: dict {metric name: [total duration, count]} to add duration of draw to,
+            which is added to metrics by caller, it is added to metrics at once if None
+        """
+        if not self._collect_metrics:
+            return self._balancer.next()
+        start = time.perf_counter()
+        idx = self._balancer.next()
+        if timings is None:
+            self._metrics.add('balancer_next', time.perf_counter() - start)
+        else:
+            self._add_timing(timings, 'balancer_next', time.perf_counter() - start)
+        return idx
+
+    def _process_instance(self, instance, timings=None):
+        processed = {}
+        if timings is None:
+            for _, process, input_names in self._process_calls:
+                processed.update(process(**{k: instance[k] for k in input_names}))
+            return processed
+
+        start = time.perf_counter()
+        for metric_name, process, input_names in self._process_calls:
+            processed.update(process(**{k: instance[k] for k in input_names}))
+            end = time.perf_counter()
+            timing = timings.get(metric_name)
+            if timing is None:
+                timings[metric_name] = [end - start, 1]
+            else:
+                timing[0] += end - start
+                timing[1] += 1
+            start = end
+        return processed
+
+    def _process_instances(self, instances):
+        processed = {}
+        for name, processor in self._preprocessors.items():
+            start = time.perf_counter()
+            processed.update(processor.process_batch(**{k: instances[k] for k in processor.provide_input}))
+            if self._collect_metrics:
+                self._metrics.add('{}/batch'.format(self._metric_names[name]), time.perf_counter() - start)
+        return processed
+
+    def _sample_random_state(self, idx, epoch):
+        if self._seed is None:
+            return nullcontext()
+        return seeded_random_state(derive_seed(self._seed, epoch, idx))
+
+    def _process_sample(self, idx, instance, epoch, timings):
+        """
+        :return: dict {name: processed data}, None if sample failed
+        """
+        try:
+            if self._seed is None:
+                return self._process_instance(instance, timings)
+            with self._sample_random_state(idx, epoch):
+                return self._process_instance(instance, timings)
+        except (IndexError, IOError, ValueError) as _:
+            logger.info('Probably no data for {}, {}'.format(idx, instance))
+            self._metrics.count('failed_samples')
+            return None
+
+    def _process_chunk(self, indices, instances, epoch=None):
+        """
+        :param indices: list of sample indices
+        :param instances: dict {data_name: sequence of data aligned with indices}
+        :param epoch: epoch of the samples, current epoch of iterator if None
+        :return: positions of successfully processed samples in indices, dict {name: sequence of processed data}
+        """
+        epoch = self._epoch if epoch is None else epoch
+        if self._batch_process and self._seed is None:
+            try:
+                return list(range(len(indices))), self._process_instances(instances)
+            except (IndexError, IOError, ValueError) as _:
+                logger.info('Falling back to per sample processing for {}'.format(indices))
+
+        # latencies of samples are added to metrics as their means once per chunk
+        timings = {} if self._collect_metrics else None
+        positions_ok, processed = [], {}
+        for num, idx in enumerate(indices):
+            data_instances_to_app = self._process_sample(idx, {k: data[num] for k, data in instances.items()},
+                                                         epoch, timings)
+            if data_instances_to_app is None:
+                continue
+
+            positions_ok.append(num)
+            for key, data in data_instances_to_app.items():
+                processed.setdefault(key, []).append(data)
+        if timings:
+            self._add_timings(timings)
+        return positions_ok, processed
+
     def next(self):
         if self._num_batches is not None and self._num_batches == self._batch_counter:
             raise StopIteration
 
-        data_packs = defaultdict(list)
+        data_packs = {}
         indices_to_ret = []
-        sample_num = 0
-        while sample_num < self._batch_size:
-            cur_idx = self._balancer.next()
-            instance = None
-            try:
-                data_instances_to_app = {}
-                for key, processor in self._preprocessors.items():
-                    input_keys = processor.provide_input
-                    instance = {k: self._data[k][cur_idx] for k in input_keys}
-                    data_instances_to_app.update(processor.process(**instance))
-
-                sample_num += 1
-                indices_to_ret.append(cur_idx)
-                for key, data in data_instances_to_app.items():
-                    data_packs[key].append(data)
-            except (IndexError, IOError, ValueError) as _:
-                logger.info('Probably no data for {}, {}'.format(cur_idx, instance))
+        if self._batch_process:
+            while len(indices_to_ret) < self._batch_size:
+                indices = [self._next_index() for _ in range(self._batch_size - len(indices_to_ret))]
+                instances = {k: self._gather(k, indices) for k in self._input_names}
+
+                positions_ok, processed = self._process_chunk(indices, instances)
+                self._store_chunk(data_packs, len(indices_to_ret), len(positions_ok), processed)
+                indices_to_ret.extend(indices[pos] for pos in positions_ok)
+        else:
+            # samples are taken one by one straight from data, latencies are added to metrics as their means
+            # once per batch
+            timings = {} if self._collect_metrics else None
+            while len(indices_to_ret) < self._batch_size:
+                idx = self._next_index(timings)
+                processed = self._process_sample(idx, {k: self._data[k][idx] for k in self._input_names},
+                                                 self._epoch, timings)
+                if processed is not None:
+                    self._store_sample(data_packs, len(indices_to_ret), processed)
+                    indices_to_ret.append(idx)
+            if timings:
+                self._add_timings(timings)
 
         self._batch_counter += 1
 
         return self._pack_to_backend(data_packs, indices_to_ret)
 
-    __next__ = next
+    def __next__(self):
+        # looked up at call time, so that next of subclasses is used by for loops
+        return self.next()
+
+    def _batch_buffer(self, key, data):
+        if self._reuse_buffers and key in self._buffers:
+            return self._buffers[key]
+
+        data = np.asarray(data)
+        buf = np.empty((self._batch_size,) + data.shape, dtype=data.dtype)
+        if self._reuse_buffers:
+            self._buffers[key] = buf
+        return buf
+
+    def _store_sample(self, data_pack, pos, processed):
+        for key, data in processed.items():
+            if key in self._buffered_names:
+                if key not in data_pack:
+                    data_pack[key] = self._batch_buffer(key, data)
+                data_pack[key][pos] = data
+            else:
+                data_pack.setdefault(key, []).append(data)
+
+    def _store_chunk(self, data_pack, start, num_samples, processed):
+        for key, data in processed.items():
+            if key in self._buffered_names:
+                if key not in data_pack:
+                    data_pack[key] = self._batch_buffer(key, data[0])
+                if isinstance(data, np.ndarray):
+                    data_pack[key][start:start + num_samples] = data
+                else:
+                    for num, item in enumerate(data):
+                        data_pack[key][start + num] = item
+            else:
+                data_pack.setdefault(key, []).extend(data)
+
+    def _consume_chunk(self, data_pack, indices_to_ret, indices, processed):
+        """
+        Stores as many samples of chunk as batch can take
+        :return: the rest of chunk, None if chunk is consumed completely
+        """
+        num_to_take = min(len(indices), self._batch_size - len(indices_to_ret))
+        self._store_chunk(data_pack, len(indices_to_ret), num_to_take,
+                          {k: v[:num_to_take] for k, v in processed.items()})
+        indices_to_ret.extend(indices[:num_to_take])
+
+        if num_to_take < len(indices):
+            return indices[num_to_take:], {k: v[num_to_take:] for k, v in processed.items()}
+        return None
+
+    def _pack_one(self, key, packed, num_samples):
+        if key in self._buffered_names and packed is not None:
+            batch = packed[:num_samples]
+        else:
+            batch = self.packers[self._packers[key]](packed if packed is not None else [])
+        return self._finalize_batch(key, batch) if num_samples != 0 else batch
+
+    def _finalize_batch(self, key, batch):
+        processor = self._finalizers.get(key)
+        if processor is None:
+            return batch
+
+        buf = self._finalized_buffers.get(key)
+        finalized = processor.finalize_batch(key, batch, out=buf[:len(batch)] if buf is not None else None)
+        if self._reuse_buffers and buf is None and finalized is not batch and len(batch) == self._batch_size:
+            self._finalized_buffers[key] = finalized
+        return finalized
 
     def _pack_to_backend(self, data_pack, indices_pack):
-        data_batched = [self.packers[self._packers[key]](data_pack[key]) for key, _ in self.provide_data]
+        start = time.perf_counter()
+        data_batched = [self._pack_one(key, data_pack.get(key), len(indices_pack)) for key, _ in self._provided]
+        if self._collect_metrics:
+            self._metrics.add('pack', time.perf_counter() - start)
+        self._metrics.count('batches')
+        self._metrics.count('samples', len(indices_pack))
         if not self._return_indices:
             return data_batched
         else:
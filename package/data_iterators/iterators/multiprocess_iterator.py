@@ -1,5 +1,7 @@
+import os
+import time
 import multiprocessing as mp
-from collections import defaultdict
+from collections import deque
 from queue import Full, Empty
 
 import logging
@@ -7,7 +9,9 @@ import numpy as np
 from multiprocessing_logging import install_mp_handler
 
 from .base_iterator import BaseIterator
-from ...routines.mp_routines import ArrayDictQueue
+from ...routines.metrics_routines import Metrics
+from ...routines.mp_routines import ArrayDictQueue, BatchSlabs, SharedNDArray
+from ...routines.random_routines import derive_seed, seed_global_random
 from ... import ROOT_LOGGER_NAME, ROOT_LOGGER_LEVEL
 logger = logging.getLogger('{}.{}'.format(ROOT_LOGGER_NAME, __name__))
 logger.setLevel(ROOT_LOGGER_LEVEL)
@@ -16,105 +20,555 @@ install_mp_handler(logger=logger)
 
 class MultiProcessIterator(BaseIterator):
     """Iterates through data with base iterator interface, implementing in-batch parallelism"""
-    def __init__(self, num_processes, max_tasks=100, max_results=100, use_shared=False, *args, **kwargs):
+    def __init__(self, num_processes, max_tasks=100, max_results=100, use_shared=False, chunk_size=1,
+                 share_data=False, num_slabs=None, deterministic=False, reorder_window=None, max_task_retries=1,
+                 *args, **kwargs):
         """
         :param num_processes: number of processes two be used by iterator
         :param max_tasks: max number of tasks to be put in tasks queue
         :param max_results: max volume of output queue
-        :param use_shared: whether to use array queue for passing big arrays without pickling them
+        :param use_shared: whether to use array queue for passing big arrays without pickling them,
+                           shapes and dtypes of its slots are taken from the first chunk, processed in main process
+        :param chunk_size: number of samples in one task, worker returns them as one collated mini-batch
+        :param share_data: pass only indices to workers, which look data up themselves,
+                           numpy data is moved to shared memory (memory-mapped arrays are left as is)
+        :param num_slabs: if set, this many batch-shaped slabs are allocated in shared memory for every output
+                          and workers write samples straight into their rows, failed rows are refilled with
+                          next samples of balancer; batch is returned as view of slab if reuse_buffers is set
+                          (valid until the next call of next), otherwise as one copy of slab
+        :param deterministic: batches are composed in balancer order instead of order of finishing
+                              and samples are processed with random state derived from (seed, epoch, index)
+                              (seed is 0 if not given), so batches are the same as of BaseIterator with the same seed
+        :param reorder_window: max number of tasks dispatched ahead of the first unfinished one in deterministic mode,
+                               max_tasks by default
+        :param max_task_retries: how many times task is requeued after crash of worker processing it,
+                                 then its samples are considered failed
+
+        Workers are supervised: if any worker dies (killed by OOM, crashed in native code), all of them are
+        restarted with new queues, as dead process can leave shared queues locked or with partial message,
+        and every task without result is requeued, see worker_stats.
+        Without seed, global random generators of every started worker are reseeded from its pid, id and
+        number of starts, so that workers do not repeat random augmentations of each other.
         """
 
         super(MultiProcessIterator, self).__init__(*args, **kwargs)
         self._num_processes = num_processes
+        self._chunk_size = chunk_size
+        self._pending_task = None
+        self._carry = None
+        self._carry_lease = None  # lease of shared slot of carried chunk
+        self._leases = []  # leases of consumed chunks, which data is referenced by batch until packing
+
+        self._deterministic = deterministic
+        if deterministic:
+            assert not num_slabs, 'slabs are refilled in order of finishing, they cannot be used in deterministic mode'
+            self._seed = self._seed or 0
+        self._task_seq = 0
+        self._next_seq = 0
+        self._reordered = {}
+
+        self._share_data = share_data
+        self._shared_columns = {}
+        if share_data:
+            self._data = {key: self._data[key] for key in self._input_names}
+            self._shared_columns = {
+                key: SharedNDArray.from_array(data) for key, data in self._data.items()
+                if isinstance(data, np.ndarray) and not isinstance(data, np.memmap) and data.dtype != object
+            }
+            self._data.update({key: shared.array for key, shared in self._shared_columns.items()})
+
         self._max_tasks = max(max_tasks, self._batch_size)
-        self._max_results = max(max_results, self._batch_size)
+        # shared slots of chunks referenced by batch until packing, with the carried one, always fit in results
+        self._max_results = max(max_results, self._batch_size, -(-self._batch_size // chunk_size) + 1)
+        self._reorder_window = reorder_window or self._max_tasks
 
-        self._input_storage = mp.Queue(maxsize=self._max_tasks)
-        if use_shared:
-            check_packers_sh_mem = reduce(
-                lambda x, y: x and y, [i in ['numpy', 'mxnet'] for i in self._packers.values()]
-            )
+        self._max_task_retries = max_task_retries
+        self._poll_interval = 1.
+        self._warn_interval = 60.
+        self._metrics_interval = 1.
+        self._in_flight = {}  # seq: task, for tasks dispatched to workers, which results are not received yet
+        self._attempts = {}
+        self._retry_tasks = deque()
+        self._local_results = deque()  # failed results of tasks given up after crashes of workers
+        self._worker_stats = {'crashed_workers': 0, 'requeued_tasks': 0, 'dropped_tasks': 0}
+        self._worker_starts = 0
+
+        self._use_shared = use_shared and not num_slabs
+        self._slabs = None
+        self._shared_templates = None
+        if num_slabs:
+            assert all(i == 'numpy' for i in self._packers.values()), 'numpy packers needed for slabs'
+            self._init_slabs(num_slabs)
+        elif use_shared:
+            check_packers_sh_mem = all(i in ['numpy', 'mxnet'] for i in self._packers.values())
             assert check_packers_sh_mem, 'array packers needed for shared memory iterator'
-            logger.warning("Only floats are supported for array queue")
-            self._output_storage = ArrayDictQueue(
-                templates={name: np.zeros(shape[1:], dtype=float) for name, shape in self.provide_data},
-                maxsize=self._max_results)
-        else:
-            self._output_storage = mp.Queue(maxsize=self._max_results)
+            self._shared_templates = {name: np.zeros((self._chunk_size,) + template.shape, dtype=template.dtype)
+                                      for name, template in self._probe_templates().items()}
 
-        worker_func = self._make_worker_func()
-        self._workers = []
-        for i in range(num_processes):
-            proc = mp.Process(target=worker_func,  args=(self._input_storage, self._output_storage))
-            proc.daemon = True
-            proc.start()
-            self._workers.append(proc)
+        self._worker_func = self._make_worker_func()
+        self._start_workers()
         self._continue = self.next_tasks()
 
     def _make_worker_func(self):
-        def task_func(task_queue, result_queue):
+        def task_func(worker_id, task_queue, result_queue):
+            # forked workers inherit random state of main process, so they are reseeded not to repeat augmentations,
+            # samples are seeded one by one, if seed is given
+            if self._seed is None:
+                seed_global_random(derive_seed(os.getpid(), self._worker_starts, worker_id))
+
+            # metrics copied from main process are dropped, the ones of worker are sent to it with results,
+            # metrics of preprocessors are emptied in place, as they can be held by their parts (cached nodes)
+            self._metrics = Metrics()
+            for _, processor_metrics in self._preprocessor_metrics():
+                processor_metrics.pop()
+            metrics_sent = time.time()
+
             while True:
-                result = {}
+                wait_start = time.perf_counter()
                 bundle = task_queue.get()  # waiting for available task
-                idx, data_pack = bundle['index'], {k: v for k, v in bundle.items() if k != 'index'}
+                task_start = time.perf_counter()
+                self._metrics.count('worker_idle', task_start - wait_start)
+                self._current_tasks[worker_id] = bundle['seq']
+                indices = bundle['index']
                 try:
-                    for key, processor in self._preprocessors.items():
-                        input_keys = processor.provide_input
-                        instance = {k: data_pack[k] for k in input_keys}
+                    if self._share_data:
+                        data_pack = {key: self._gather(key, indices) for key in self._input_names}
+                    else:
+                        data_pack = {key: bundle[key] for key in self._input_names}
+                    positions_ok, processed = self._process_chunk(indices, data_pack, bundle['epoch'])
+                except Exception as _:
+                    logger.exception('Failed to process {}'.format(indices))
+                    positions_ok, processed = [], {}
 
-                        result.update(processor.process(**instance))
-                    result.update({'index': idx})
-                    result_queue.put(result)
+                # result is sent even if every sample failed, so that task is known to be done
+                indices_ok = [indices[pos] for pos in positions_ok]
+                if 'slab' in bundle:
+                    rows = bundle['rows']
+                    rows_ok = [rows[pos] for pos in positions_ok]
+                    self._slabs.write(bundle['slab'], rows_ok, processed)
+                    result = {
+                        'index': indices_ok, 'seq': bundle['seq'], 'slab': bundle['slab'], 'rows': rows_ok,
+                        'failed': sorted(set(rows) - set(rows_ok))
+                    }
+                else:
+                    result = {key: self._collate(key, data) for key, data in processed.items()}
+                    result.update({'index': indices_ok, 'seq': bundle['seq']})
 
-                except (IndexError, IOError) as _:
-                    logger.info('Probably no data for {}'.format(idx))
+                put_start = time.perf_counter()
+                self._metrics.count('worker_busy', put_start - task_start)
+                # metrics are sent periodically and before worker runs out of tasks, e.g. at the end of data
+                if time.time() - metrics_sent > self._metrics_interval or task_queue.empty():
+                    result['metrics'] = self._pop_metrics()
+                    metrics_sent = time.time()
+                result_queue.put(result)
+                self._metrics.count('worker_blocked', time.perf_counter() - put_start)
 
         return task_func
 
+    def _start_workers(self):
+        self._worker_starts += 1
+        self._input_storage = mp.Queue(maxsize=self._max_tasks)
+        if self._use_shared:
+            self._output_storage = ArrayDictQueue(templates=self._shared_templates, maxsize=self._max_results)
+        else:
+            self._output_storage = mp.Queue(maxsize=self._max_results)
+        self._current_tasks = mp.Array('q', [-1] * self._num_processes, lock=False)  # seq of the last task taken
+
+        self._workers = []
+        for worker_id in range(self._num_processes):
+            proc = mp.Process(target=self._worker_func, args=(worker_id, self._input_storage, self._output_storage))
+            proc.daemon = True
+            proc.start()
+            self._workers.append(proc)
+
+    def _stop_workers(self):
+        for proc in self._workers:
+            if proc.is_alive():
+                proc.terminate()
+        for proc in self._workers:
+            proc.join()
+
+        # queues are abandoned, results left in them are never read
+        self._input_storage.cancel_join_thread()
+        self._output_storage.cancel_join_thread()
+
+    def _pop_metrics(self):
+        metrics = self._metrics.pop()
+        for name, processor_metrics in self._preprocessor_metrics():
+            metrics.merge(processor_metrics.pop(), prefix='{}/'.format(self._metric_names[name]))
+        return metrics
+
+    @property
+    def metrics(self):
+        """
+        :return: dict snapshot of metrics of BaseIterator, with the ones of workers, sent every second with results:
+                 time spent by workers waiting for tasks, processing them and waiting to put results
+                 ('worker_idle', 'worker_busy', 'worker_blocked' counters) and worker_utilization,
+                 time spent by main process waiting for results ('wait_result'),
+                 depths of task and result queues, worker_stats
+        """
+        snapshot = super(MultiProcessIterator, self).metrics
+        counters = snapshot['counters']
+        worker_time = sum(counters.get(name, 0) for name in ('worker_idle', 'worker_busy', 'worker_blocked'))
+        if worker_time != 0:
+            snapshot['worker_utilization'] = counters.get('worker_busy', 0) / worker_time
+        snapshot['workers'] = self.worker_stats
+        return snapshot
+
+    def _record_queue_depths(self):
+        for name, queue in (('task_queue_depth', self._input_storage), ('result_queue_depth', self._output_storage)):
+            try:
+                self._metrics.add(name, queue.qsize(), base=1)
+            except NotImplementedError:
+                pass  # qsize is not available on macOS
+
+    @property
+    def worker_stats(self):
+        """
+        :return: dict with numbers of crashed workers, requeued tasks and tasks given up after max_task_retries
+        """
+        return dict(self._worker_stats)
+
+    def _check_workers(self):
+        """
+        Restarts workers if any of them is dead, every task without result is requeued
+        """
+        # more tasks can be in flight than task queue takes, requeued ones are dispatched as queue frees
+        self._dispatch_retries()
+        dead = [worker_id for worker_id, proc in enumerate(self._workers) if not proc.is_alive()]
+        if len(dead) == 0:
+            return
+
+        # task being processed by dead worker could cause the crash
+        suspects = {self._current_tasks[worker_id] for worker_id in dead}
+        self._worker_stats['crashed_workers'] += len(dead)
+        logger.warning('Workers {} died with exit codes {}, restarting workers, {} tasks are requeued'.format(
+            dead, [self._workers[worker_id].exitcode for worker_id in dead], len(self._in_flight)))
+
+        self._stop_workers()
+        self._retry_tasks = deque()
+        for seq in sorted(self._in_flight):
+            self._retry_task(seq, is_suspect=seq in suspects)
+        self._start_workers()
+        self._dispatch_retries()
+
+    def _retry_task(self, seq, is_suspect):
+        task = self._in_flight[seq]
+        if is_suspect:
+            self._attempts[seq] = self._attempts.get(seq, 0) + 1
+        if self._attempts.get(seq, 0) <= self._max_task_retries:
+            self._worker_stats['requeued_tasks'] += 1
+            self._retry_tasks.append(task)
+            return
+
+        # failed result of task is made up instead of the one from worker
+        self._worker_stats['dropped_tasks'] += 1
+        logger.error('Giving up task {} with samples {} after {} crashes of workers'.format(
+            seq, task['index'], self._attempts[seq]))
+        result = {'index': [], 'seq': seq}
+        if 'slab' in task:
+            result.update({'slab': task['slab'], 'rows': [], 'failed': task['rows']})
+        self._accept_result(result)
+        self._local_results.append(result)
+
+    def _dispatch_retries(self):
+        try:
+            while len(self._retry_tasks) != 0:
+                self._input_storage.put_nowait(self._retry_tasks[0])
+                self._retry_tasks.popleft()
+        except Full:
+            pass
+
+    def _probe_templates(self):
+        """
+        Processes one sample in main process to find out real shapes and dtypes of outputs,
+        processed sample is kept for the first batch
+        """
+        while self._carry is None:
+            indices = [self._next_index()]
+            data_pack = {key: self._gather(key, indices) for key in self._input_names}
+
+            positions_ok, processed = self._process_chunk(indices, data_pack)
+            if len(positions_ok) != 0:
+                self._carry = indices, {key: self._collate(key, data) for key, data in processed.items()}
+
+        return {name: np.zeros(data.shape[1:], dtype=data.dtype) for name, data in self._carry[1].items()}
+
+    def _init_slabs(self, num_slabs):
+        self._slabs = BatchSlabs(templates=self._probe_templates(), batch_size=self._batch_size, num_slabs=num_slabs)
+        self._buffered_names = {name for name, _ in self._provided}
+        self._free_slabs = deque(range(num_slabs))
+        self._slab_order = deque()  # slabs being filled, in order of batches
+        self._slab_states = {}
+        self._returned_slab = None
+
+        # sample processed while probing goes to the first row of the first slab
+        indices, processed = self._carry
+        slab = self._open_slab()
+        self._slabs.write(slab, [0], processed)
+        self._slab_states[slab]['indices'][0] = indices[0]
+        self._slab_states[slab]['filled'][0] = True
+        self._slab_states[slab]['next_row'] = 1
+        self._carry = None
+
+    def _open_slab(self):
+        slab = self._free_slabs.popleft()
+        self._slab_states[slab] = {
+            'indices': [None] * self._batch_size, 'filled': np.zeros(self._batch_size, dtype=bool),
+            'next_row': 0, 'refill': [], 'outstanding': 0
+        }
+        self._slab_order.append(slab)
+        return slab
+
+    def _slab_rows_to_fill(self):
+        """
+        :return: slab and rows, for which the next task is to be made, or None if every slab is busy
+        """
+        for slab in self._slab_order:
+            state = self._slab_states[slab]
+            if len(state['refill']) != 0:
+                rows, state['refill'] = state['refill'][:self._chunk_size], state['refill'][self._chunk_size:]
+                return slab, rows
+            if state['next_row'] < self._batch_size:
+                rows = list(range(state['next_row'], min(state['next_row'] + self._chunk_size, self._batch_size)))
+                state['next_row'] = rows[-1] + 1
+                return slab, rows
+
+        if len(self._free_slabs) != 0:
+            self._open_slab()
+            return self._slab_rows_to_fill()
+        return None
+
+    def _collate(self, key, data):
+        if isinstance(data, np.ndarray) or self._packers.get(key) == 'list':
+            return data
+        try:
+            return np.stack(data)
+        except ValueError:
+            return data
+
     def reset(self):
         super(MultiProcessIterator, self).reset()
         self._continue = self.next_tasks()
 
+    def _make_task(self):
+        destination = None
+        num_to_draw = self._chunk_size
+        if self._slabs is not None:
+            destination = self._slab_rows_to_fill()
+            if destination is None:
+                return None
+            num_to_draw = len(destination[1])
+
+        indices = []
+        try:
+            while len(indices) < num_to_draw:
+                indices.append(self._next_index())
+        except StopIteration:
+            if len(indices) == 0:
+                raise
+
+        task = {} if self._share_data else {key: self._gather(key, indices) for key in self._input_names}
+        task.update({'index': indices, 'seq': self._task_seq, 'epoch': self._epoch})
+        self._task_seq += 1
+        if destination is not None:
+            slab, rows = destination
+            task.update({'slab': slab, 'rows': rows[:len(indices)]})
+            self._slab_states[slab]['outstanding'] += 1
+        return task, len(indices) == num_to_draw
+
     def next_tasks(self, num_tasks=None):
+        self._dispatch_retries()
+        if len(self._retry_tasks) != 0:
+            return True
+
         task_added = 0
         num_tasks = num_tasks or self._max_tasks
         while task_added < num_tasks:  # iterate until full or stop
             try:
-                idx = self._balancer.next()
-                data_pack = {key: data[idx] for key, data in self._data.items()}
-                data_pack.update({'index': idx})
+                if self._deterministic and self._pending_task is None \
+                        and self._task_seq >= self._next_seq + self._reorder_window:
+                    return True  # reorder window is full
+                if self._pending_task is None:
+                    self._pending_task = self._make_task()
+                if self._pending_task is None:
+                    return True  # every slab is busy
+                task, is_full_chunk = self._pending_task
 
-                self._input_storage.put_nowait(data_pack)
+                self._input_storage.put_nowait(task)
+                self._in_flight[task['seq']] = task
+                self._pending_task = None
                 task_added += 1
+                if not is_full_chunk:
+                    return False
             except Full:
                 return True
             except StopIteration:
                 return False
         return True
 
+    def _accept_result(self, bundle):
+        self._in_flight.pop(bundle['seq'])
+        self._attempts.pop(bundle['seq'], None)
+        if 'metrics' in bundle:
+            self._metrics.merge(bundle.pop('metrics'))
+
+    def _get_bundle(self):
+        """
+        Waits for the next result of dispatched task, supervising workers meanwhile
+        :return: result and its lease, None if result is not leased
+        :raises Empty: if results of all dispatched tasks are received
+        """
+        waited = 0
+        wait_start = time.perf_counter()
+        while len(self._local_results) == 0:
+            if len(self._in_flight) == 0:
+                raise Empty
+
+            self._dispatch_retries()
+            try:
+                if self._use_shared:
+                    lease = self._output_storage.lease(True, self._poll_interval)
+                    bundle = lease.items
+                else:
+                    bundle, lease = self._output_storage.get(True, self._poll_interval), None
+            except Empty:
+                self._check_workers()
+                waited += self._poll_interval
+                if waited % self._warn_interval < self._poll_interval:
+                    logger.warning('No results for {:.0f}s, waiting for {} tasks'.format(
+                        waited, len(self._in_flight)))
+                continue
+
+            self._accept_result(bundle)
+            self._metrics.add('wait_result', time.perf_counter() - wait_start)
+            return bundle, lease
+        return self._local_results.popleft(), None
+
+    def _next_bundle(self):
+        if not self._deterministic:
+            bundle, lease = self._get_bundle()
+        else:
+            while self._next_seq not in self._reordered:
+                # window moves with every result in order, so tasks are topped up while waiting
+                self._continue = self.next_tasks() if self._continue else self._continue
+                bundle, lease = self._get_bundle()
+                if lease is not None and bundle['seq'] != self._next_seq:
+                    # results coming out of order are copied, so that their slots do not block workers
+                    with lease as items:
+                        bundle = {k: v.copy() if isinstance(v, np.ndarray) else v for k, v in items.items()}
+                    lease = None
+                self._reordered[bundle['seq']] = bundle, lease
+            bundle, lease = self._reordered.pop(self._next_seq)
+            self._next_seq += 1
+
+        return bundle, lease
+
+    def _next_chunk(self):
+        if self._carry is None:
+            bundle, lease = self._next_bundle()
+            if lease is not None and len(bundle['index']) == 0:
+                # chunk, which samples all failed, holds no data, its slot is returned at once
+                lease.release()
+                lease = None
+            self._carry_lease = lease
+            self._carry = bundle['index'], {k: v for k, v in bundle.items() if k not in ('index', 'seq')}
+        return self._carry
+
+    def _release_consumed_chunk(self):
+        if self._carry_lease is None:
+            return
+        # data of buffered names is copied into batch buffers, the one of others is referenced until packing
+        if set(self._carry_lease.items) - {'index', 'seq'} <= self._buffered_names:
+            self._carry_lease.release()
+        else:
+            self._leases.append(self._carry_lease)
+        self._carry_lease = None
+
     def next(self):
         if self._num_batches is not None and self._num_batches == self._batch_counter:
             raise StopIteration
+        self._check_workers()
+        self._record_queue_depths()
+        if self._slabs is not None:
+            return self._next_from_slabs()
 
-        sample_num = 0
-        data_packs = defaultdict(list)
+        data_packs = {}
         indices_to_ret = []
-        while sample_num < self._batch_size:
+        while len(indices_to_ret) < self._batch_size:
             try:
-                bundle = self._output_storage.get(True, 10)
-                idx, data_dict = bundle['index'], {k: v for k, v in bundle.items() if k != 'index'}
-                # idx - sample index, data_dict - {'name': data, ...}
-                # if no exception here
-                sample_num += 1
-                indices_to_ret.append(idx)
-                for key, data in data_dict.items():
-                    data_packs[key].append(data)
+                indices, data_dict = self._next_chunk()
             except Empty:
-                break
+                # every dispatched task is done, batch is incomplete only if balancer is exhausted
+                if not self._continue:
+                    break
+                self._continue = self.next_tasks()
+                continue
+            # indices - sample indices of the chunk, data_dict - {'name': collated data, ...}
+            self._carry = self._consume_chunk(data_packs, indices_to_ret, indices, data_dict)
+            if self._carry is None:
+                self._release_consumed_chunk()
 
         self._continue = self.next_tasks() if self._continue else self._continue
         if not self._continue and len(indices_to_ret) == 0:
             raise StopIteration
 
-        return self._pack_to_backend(data_packs, indices_to_ret)
+        self._batch_counter += 1
+        batch = self._pack_to_backend(data_packs, indices_to_ret)
+        self._release_leases()
+        return batch
+
+    def _release_leases(self):
+        # shared slots of consumed chunks are returned once their data is packed
+        for lease in self._leases:
+            lease.release()
+        self._leases = []
+
+    def _slab_ready(self, slab):
+        state = self._slab_states[slab]
+        if state['outstanding'] != 0:
+            return False
+        return not self._continue or (state['next_row'] == self._batch_size and len(state['refill']) == 0)
+
+    def _on_slab_result(self, result):
+        state = self._slab_states[result['slab']]
+        state['outstanding'] -= 1
+        for row, idx in zip(result['rows'], result['index']):
+            state['indices'][row] = idx
+            state['filled'][row] = True
+        state['refill'].extend(result['failed'])
+
+    def _next_from_slabs(self):
+        if self._returned_slab is not None:
+            self._free_slabs.append(self._returned_slab)
+            self._returned_slab = None
+        self._continue = self.next_tasks() if self._continue else self._continue
+
+        while len(self._slab_order) != 0:
+            slab = self._slab_order[0]
+            while not self._slab_ready(slab):
+                try:
+                    self._on_slab_result(self._get_bundle()[0])
+                except Empty:
+                    pass  # nothing is in flight, rows left to fill get their tasks below
+                self._continue = self.next_tasks() if self._continue else self._continue
+
+            self._slab_order.popleft()
+            state = self._slab_states.pop(slab)
+            rows = np.flatnonzero(state['filled'])
+            indices_to_ret = [state['indices'][row] for row in rows]
+            if len(rows) == 0:
+                self._free_slabs.append(slab)
+                continue
+
+            if len(rows) == self._batch_size and self._reuse_buffers:
+                data_packs = self._slabs.batch(slab)
+                self._returned_slab = slab
+            else:
+                data_packs = self._slabs.batch(slab, rows)
+                self._free_slabs.append(slab)
+            self._batch_counter += 1
+
+            return self._pack_to_backend(data_packs, indices_to_ret)
 
+        raise StopIteration
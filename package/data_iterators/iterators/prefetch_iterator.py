@@ -0,0 +1,106 @@
+import threading
+from queue import Queue, Full
+
+import logging
+
+from ... import ROOT_LOGGER_NAME, ROOT_LOGGER_LEVEL
+logger = logging.getLogger('{}.{}'.format(ROOT_LOGGER_NAME, __name__))
+logger.setLevel(ROOT_LOGGER_LEVEL)
+
+
+class PrefetchIterator(object):
+    """
+    Wraps instance of BaseIterator or MPIterator, producing its batches in background thread,
+    so that data loading overlaps with consuming of previous batches
+    """
+    def __init__(self, iterator, num_prefetch=2):
+        """
+        :param iterator: BaseIterator or MPIterator, its batches must not be reused between calls of next
+        :param num_prefetch: max number of ready batches
+        """
+        assert not getattr(iterator, '_reuse_buffers', False), 'batches of iterator are overwritten by next batches'
+        self._iterator = iterator
+        self._num_prefetch = num_prefetch
+
+        self._exhausted = False
+        self._start()
+
+    def _start(self):
+        self._stop_event = threading.Event()
+        self._batches = Queue(maxsize=self._num_prefetch)
+        self._thread = threading.Thread(target=self._produce, args=(self._batches, self._stop_event))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _produce(self, batches, stop_event):
+        while not stop_event.is_set():
+            try:
+                item = ('batch', self._iterator.next())
+            except StopIteration:
+                item = ('stop', None)
+            except Exception as e:
+                logger.exception('Exception while prefetching batch')
+                item = ('error', e)
+
+            while not stop_event.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    break
+                except Full:
+                    continue
+
+            if item[0] != 'batch':
+                return
+
+    def _shutdown(self):
+        self._stop_event.set()
+        self._thread.join()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._exhausted:
+            raise StopIteration
+
+        kind, value = self._batches.get()
+        if kind == 'batch':
+            return value
+
+        self._exhausted = True
+        if kind == 'error':
+            raise value
+        raise StopIteration
+
+    __next__ = next
+
+    def reset(self):
+        self._shutdown()
+        self._iterator.reset()
+        self._exhausted = False
+        self._start()
+
+    def close(self):
+        self._shutdown()
+
+    def get_params(self):
+        return self._iterator.get_params()
+
+    @property
+    def return_indices(self):
+        return self._iterator.return_indices
+
+    @property
+    def batch_size(self):
+        return self._iterator.batch_size
+
+    @property
+    def provide_data(self):
+        return self._iterator.provide_data
+
+    @property
+    def metrics(self):
+        return self._iterator.metrics
+
+    def reset_metrics(self):
+        self._iterator.reset_metrics()
@@ -0,0 +1,85 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import logging
+
+from .base_iterator import BaseIterator
+from ... import ROOT_LOGGER_NAME, ROOT_LOGGER_LEVEL
+logger = logging.getLogger('{}.{}'.format(ROOT_LOGGER_NAME, __name__))
+logger.setLevel(ROOT_LOGGER_LEVEL)
+
+
+class ThreadPoolIterator(BaseIterator):
+    """
+    Iterates through data with base iterator interface, processing chunks of samples on pool of threads,
+    suitable for preprocessors spending their time in code releasing GIL (cv2, numpy, ffmpeg pipes)
+    """
+    def __init__(self, num_threads, max_tasks=100, chunk_size=1, *args, **kwargs):
+        """
+        :param num_threads: number of threads to be used by iterator
+        :param max_tasks: max number of chunks being processed or waiting for processing
+        :param chunk_size: number of samples in one task
+
+        Batches are composed in balancer order, as in BaseIterator. Global random state is shared by threads,
+        so seed does not make augmentations reproducible here.
+        """
+        super(ThreadPoolIterator, self).__init__(*args, **kwargs)
+        if self._seed is not None:
+            logger.warning('seed does not make processing reproducible when samples are processed by threads')
+
+        self._chunk_size = chunk_size
+        self._max_tasks = max(max_tasks, -(-self._batch_size // chunk_size))
+        self._executor = ThreadPoolExecutor(max_workers=num_threads)
+
+        self._futures = deque()
+        self._carry = None
+        self._continue = self.next_tasks()
+
+    def reset(self):
+        super(ThreadPoolIterator, self).reset()
+        self._continue = self.next_tasks()
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, indices):
+        instances = {key: self._gather(key, indices) for key in self._input_names}
+        future = self._executor.submit(self._process_chunk, indices, instances, self._epoch)
+        self._futures.append((indices, future))
+
+    def next_tasks(self):
+        while len(self._futures) < self._max_tasks:
+            indices = []
+            try:
+                while len(indices) < self._chunk_size:
+                    indices.append(self._next_index())
+            except StopIteration:
+                if len(indices) != 0:
+                    self._submit(indices)
+                return False
+            self._submit(indices)
+        return True
+
+    def _next_chunk(self):
+        if self._carry is None:
+            indices, future = self._futures.popleft()
+            positions_ok, processed = future.result()
+            self._carry = [indices[pos] for pos in positions_ok], processed
+            self._continue = self.next_tasks() if self._continue else self._continue
+        return self._carry
+
+    def next(self):
+        if self._num_batches is not None and self._num_batches == self._batch_counter:
+            raise StopIteration
+
+        data_packs = {}
+        indices_to_ret = []
+        while len(indices_to_ret) < self._batch_size and (self._carry is not None or len(self._futures) != 0):
+            indices, processed = self._next_chunk()
+            self._carry = self._consume_chunk(data_packs, indices_to_ret, indices, processed)
+
+        if len(indices_to_ret) == 0:
+            raise StopIteration
+
+        self._batch_counter += 1
+        return self._pack_to_backend(data_packs, indices_to_ret)
@@ -7,6 +7,34 @@ logger = logging.getLogger('{}.{}'.format(ROOT_LOGGER_NAME, __name__))
 logger.setLevel(ROOT_LOGGER_LEVEL)
 
 
+def crop_frames(arr, crop):
+    """
+    :param arr: array of frames in THW... layout
+    :param crop: (top, left, height, width) or function of shape of arr returning them
+    :return: view of arr, cropped along axes 1 and 2
+    """
+    if crop is None:
+        return arr
+    top, left, height, width = crop(arr.shape) if callable(crop) else crop
+    return arr[:, top:top + height, left:left + width]
+
+
+def read_array(path, frame_indices=None, crop=None):
+    """
+    Reads array from .npy file, if frame_indices or crop are given, file is memory mapped
+    and only selected part of array is copied out
+    :param frame_indices: indices along the first axis or function of its length returning them
+    :param crop: spatial crop of frames, see crop_frames
+    """
+    if frame_indices is None and crop is None:
+        return np.load(path)
+
+    arr = crop_frames(np.load(path, mmap_mode='r'), crop)
+    if callable(frame_indices):
+        frame_indices = frame_indices(arr.shape[0])
+    return arr[frame_indices] if frame_indices is not None else np.array(arr)
+
+
 class BasePreprocessor(object):
     """Base class for preprocessors"""
     def __init__(self, name=None, shape=None, *args, **kwargs):
@@ -16,6 +44,36 @@ class BasePreprocessor(object):
     def process(self, **kwargs):
         pass
 
+    def process_batch(self, **kwargs):
+        """
+        Processes several samples at once, by default calls process for every sample,
+        subclasses override it with vectorized implementations
+        :param kwargs: {input_name: list or stacked array of per sample inputs}
+        :return: {output_name: list or stacked array of per sample outputs}
+        """
+        batch_len = len(next(iter(kwargs.values())))
+        processed = {}
+        for num in range(batch_len):
+            sample = self.process(**{name: data[num] for name, data in kwargs.items()})
+            for name, data in sample.items():
+                processed.setdefault(name, []).append(data)
+        return processed
+
+    def finalize_batch(self, name, batch, out=None):
+        """
+        Called by iterators on packed batch of output name, lets preprocessors defer work to whole batches,
+        returns batch as is by default
+        :param out: array to write finalized batch into, if preprocessor can do it
+        """
+        return batch
+
+    @property
+    def deferred_outputs(self):
+        """
+        Names of outputs, which are returned by process unfinished and are to be finished by finalize_batch
+        """
+        return []
+
     @property
     def provide_data(self):
         return [(self._name, self._shape)]
@@ -61,14 +119,29 @@ class IdentityPreprocessor(BasePreprocessor):
     def process(self, **kwargs):
         return {key: np.atleast_1d(data) for key, data in kwargs.items()}
 
+    def process_batch(self, **kwargs):
+        processed = {}
+        for key, data in kwargs.items():
+            data = np.asarray(data)
+            processed[key] = data[:, np.newaxis] if data.ndim == 1 else data
+        return processed
+
 
 class ArrayReader(BasePreprocessor):
-    def __init__(self, name, shape, format_string, *args, **kwargs):
+    def __init__(self, name, shape, format_string, frame_indices=None, crop=None, *args, **kwargs):
+        """
+        :param frame_indices: indices along the first axis to be read or function of its length returning them
+        :param crop: spatial crop of frames, (top, left, height, width) or function of shape returning them,
+            only selected frames and crops are read from memory mapped files, see read_array
+        """
         super(ArrayReader, self).__init__(name, shape, *args, **kwargs)
         self._format_string = format_string
+        self._frame_indices = frame_indices
+        self._crop = crop
 
     def process(self, **kwargs):
-        return {key: np.load(self._format_string.format(data)) for key, data in kwargs.items()}
+        return {key: read_array(self._format_string.format(data), self._frame_indices, self._crop)
+                for key, data in kwargs.items()}
 
 
 class ZeroArrayReader(BasePreprocessor):
@@ -79,6 +152,9 @@ class ZeroArrayReader(BasePreprocessor):
     def process(self, **kwargs):
         return {key: np.zeros(self._shape, dtype=self._dt) for key, data in kwargs.items()}
 
+    def process_batch(self, **kwargs):
+        return {key: np.zeros((len(data),) + tuple(self._shape), dtype=self._dt) for key, data in kwargs.items()}
+
 
 class ArrayGetter(BasePreprocessor):
     def __init__(self, func=None, *args, **kwargs):
@@ -90,13 +166,23 @@ class ArrayGetter(BasePreprocessor):
 
 
 class ArrayTransformer(BasePreprocessor):
-    def __init__(self, transformer, *args, **kwargs):
+    def __init__(self, transformer, batch_transformer=None, *args, **kwargs):
+        """
+        :param transformer: function applied to every sample
+        :param batch_transformer: optional vectorized version of transformer, applied to stacked samples
+        """
         super(ArrayTransformer, self).__init__(*args, **kwargs)
         self._transformer = transformer
+        self._batch_transformer = batch_transformer
 
     def process(self, **kwargs):
         return {key: self._transformer(data) for key, data in kwargs.items()}
 
+    def process_batch(self, **kwargs):
+        if self._batch_transformer is None:
+            return super(ArrayTransformer, self).process_batch(**kwargs)
+        return {key: self._batch_transformer(np.asarray(data)) for key, data in kwargs.items()}
+
 
 class SlowZeroArrayReader(ZeroArrayReader):
     def process(self, **kwargs):
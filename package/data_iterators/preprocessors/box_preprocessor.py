@@ -52,6 +52,19 @@ class BoxLabelBatchify(MIMOPreprocessor):
 
         return {name: pack for name, pack in zip(self.provide_output, [boxes_batched, labels_batched])}
 
+    def process_batch(self, **kwargs):
+        boxes_list = kwargs[self.provide_input[0]]
+        labels_list = kwargs[self.provide_input[1]]
+
+        labels_batched = - np.ones((len(labels_list), self._max_boxes, 1))
+        boxes_batched = np.zeros((len(boxes_list), self._max_boxes, 4))
+
+        for num, (boxes, labels) in enumerate(zip(boxes_list, labels_list)):
+            labels_batched[num, :min(labels.shape[0], self._max_boxes), :] = labels[:self._max_boxes]
+            boxes_batched[num, :min(boxes.shape[0], self._max_boxes), :] = boxes[:self._max_boxes]
+
+        return {name: pack for name, pack in zip(self.provide_output, [boxes_batched, labels_batched])}
+
 
 class CropRGBImage(MIMOPreprocessor):
     def __init__(self, data_names=('image',), input_names=('image', 'crop'), *args, **kwargs):
@@ -0,0 +1,177 @@
+import os
+import uuid
+import types
+import functools
+import hashlib
+import threading
+import logging
+
+import numpy as np
+
+from .base_preprocessor import BasePreprocessor
+from ...routines.data_structure_routines import LRUCache, hashable_key
+from ...routines.metrics_routines import Metrics
+from ...routines.mp_routines import SharedArrayCache
+
+from ... import ROOT_LOGGER_NAME, ROOT_LOGGER_LEVEL
+logger = logging.getLogger('{}.{}'.format(ROOT_LOGGER_NAME, __name__))
+logger.setLevel(ROOT_LOGGER_LEVEL)
+
+# helpers which do not change outputs of preprocessors
+_NOT_CONFIG_TYPES = (Metrics, LRUCache, SharedArrayCache, type(threading.Lock()))
+
+
+def _describe_code(code):
+    # nested code objects (comprehensions, inner functions) are described by their contents, not by their reprs,
+    # which carry addresses, constant sets are sorted, since their order changes with hash randomization
+    consts = []
+    for const in code.co_consts:
+        if hasattr(const, 'co_code'):
+            consts.append(_describe_code(const))
+        elif isinstance(const, frozenset):
+            consts.append('frozenset({})'.format(sorted(repr(item) for item in const)))
+        else:
+            consts.append(repr(const))
+    return hashlib.sha1(code.co_code + repr((consts, code.co_names)).encode()).hexdigest()[:8]
+
+
+def _code_names(code):
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if hasattr(const, 'co_code'):
+            names |= _code_names(const)
+    return names
+
+
+def describe_config(obj, depth=4):
+    """
+    :return: text describing obj, which is the same for equally configured objects across runs:
+        functions and classes are described by their qualified names and code, objects by their attributes,
+        objects with method _config_state by what it returns, so that compiled and runtime state is left out,
+        functions by values of module globals they read as well
+    """
+    if isinstance(obj, (str, bytes, int, float, bool, type(None))):
+        return repr(obj)
+    if isinstance(obj, np.ndarray):
+        return repr(hashable_key(obj))
+    if isinstance(obj, dict):
+        return '{' + ', '.join('{}: {}'.format(key, describe_config(value, depth))
+                               for key, value in sorted(obj.items(), key=lambda item: str(item[0]))
+                               if not isinstance(value, _NOT_CONFIG_TYPES)) + '}'
+    if isinstance(obj, (list, tuple)):
+        return '[' + ', '.join(describe_config(item, depth) for item in obj) + ']'
+    if isinstance(obj, (set, frozenset)):
+        return '{' + ', '.join(sorted(describe_config(item, depth) for item in obj)) + '}'
+
+    if isinstance(obj, types.ModuleType):
+        return obj.__name__
+
+    name = '{}.{}'.format(getattr(obj, '__module__', ''), getattr(obj, '__qualname__', type(obj).__qualname__))
+    if depth == 0 or callable(obj) and not hasattr(obj, '__dict__') or isinstance(obj, type):
+        return name
+    if hasattr(obj, '__code__'):
+        # functions are told apart by their code, closures by values they enclose and globals they read as well,
+        # so that def resize(img): return cv2.resize(img, (SIZE, SIZE)) changes with SIZE
+        cells = [cell.cell_contents for cell in obj.__closure__ or ()]
+        global_names = _code_names(obj.__code__) & set(obj.__globals__)
+        globals_read = {global_name: obj.__globals__[global_name] for global_name in global_names}
+        return '{}:{}({}, {})'.format(name, _describe_code(obj.__code__), describe_config(cells, depth - 1),
+                                      describe_config(globals_read, depth - 1))
+    if isinstance(obj, functools.partial):
+        return '{}({})'.format(name, describe_config([obj.func, obj.args, obj.keywords], depth - 1))
+    if hasattr(obj, '_config_state'):
+        return '{}({})'.format(name, describe_config(obj._config_state(), depth - 1))
+    return '{}({})'.format(name, describe_config(vars(obj), depth - 1) if hasattr(obj, '__dict__') else '')
+
+
+class DiskCachedPreprocessor(BasePreprocessor):
+    """
+    Wraps deterministic preprocessor, its outputs are stored in cache_dir as .npy files
+    and are read back with memory mapping by later epochs and runs
+    """
+    def __init__(self, preprocessor, cache_dir, config=None, mmap_mode='c', *args, **kwargs):
+        """
+        :param preprocessor: deterministic preprocessor returning arrays
+        :param cache_dir: directory of cache, it can be shared by several preprocessors and runs
+        :param config: anything describing what preprocessor does, attributes of preprocessor by default,
+            outputs of preprocessors with different configs are kept apart
+        :param mmap_mode: mode of np.load, copy on write by default, so that outputs can be changed in place,
+            None to read outputs to memory
+
+        Key of outputs consists of input values, paths of existing files are accompanied by their mtimes and sizes,
+        so that outputs are recomputed when sources change.
+        """
+        super(DiskCachedPreprocessor, self).__init__(*args, **kwargs)
+        self._preprocessor = preprocessor
+        self._mmap_mode = mmap_mode
+
+        description = describe_config(preprocessor if config is None else config)
+        self._config_hash = hashlib.sha1(
+            '{}:{}'.format(type(preprocessor).__qualname__, description).encode()).hexdigest()[:16]
+        self._cache_dir = os.path.join(cache_dir, self._config_hash)
+        self.metrics = Metrics()  # hits and misses, collected by iterators
+
+    @staticmethod
+    def _source_key(data):
+        if isinstance(data, str) and os.path.isfile(data):
+            stat = os.stat(data)
+            return data, stat.st_mtime, stat.st_size
+        if isinstance(data, (list, tuple)):
+            return tuple(DiskCachedPreprocessor._source_key(item) for item in data)
+        return hashable_key(data)
+
+    def _paths(self, kwargs):
+        key = tuple((name, self._source_key(data)) for name, data in sorted(kwargs.items()))
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return {name: os.path.join(self._cache_dir, digest[:2], '{}_{}.npy'.format(digest, name))
+                for name in self.provide_output}
+
+    def process(self, **kwargs):
+        paths = self._paths(kwargs)
+        if all(os.path.exists(path) for path in paths.values()):
+            try:
+                processed = {name: np.load(path, mmap_mode=self._mmap_mode) for name, path in paths.items()}
+                self.metrics.count('disk_cache_hits')
+                return processed
+            except (IOError, ValueError):
+                logger.warning('Cannot read cached outputs {}, they are recomputed'.format(list(paths.values())))
+
+        self.metrics.count('disk_cache_misses')
+        processed = self._preprocessor.process(**kwargs)
+        self._store(paths, processed)
+        return processed
+
+    def _store(self, paths, processed):
+        for name, path in paths.items():
+            data = np.asarray(processed[name])
+            if data.dtype == object:
+                logger.warning('Output {} is not an array, it is not cached'.format(name))
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # written under temporary name, so that readers never see partial files, even from other workers
+            tmp_path = '{}.{}.tmp.npy'.format(path, uuid.uuid4().hex)
+            np.save(tmp_path, data)
+            os.replace(tmp_path, path)
+
+    def finalize_batch(self, name, batch, out=None):
+        return self._preprocessor.finalize_batch(name, batch, out=out)
+
+    @property
+    def deferred_outputs(self):
+        return self._preprocessor.deferred_outputs
+
+    @property
+    def config_hash(self):
+        return self._config_hash
+
+    @property
+    def provide_data(self):
+        return self._preprocessor.provide_data
+
+    @property
+    def provide_output(self):
+        return self._preprocessor.provide_output
+
+    @property
+    def provide_input(self):
+        return self._preprocessor.provide_input
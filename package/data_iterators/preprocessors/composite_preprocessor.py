@@ -1,7 +1,44 @@
-from collections import defaultdict
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import networkx as nx
+import numpy as np
 
 from .base_preprocessor import BasePreprocessor
+from ...routines.data_structure_routines import LRUCache, data_nbytes, hashable_key
+from ...routines.metrics_routines import Metrics
+
+
+class _CachedProcess(object):
+    """
+    Calls process of node only for input values missing in cache, arrays of cached outputs are made read only,
+    so that following nodes cannot spoil them in place
+    """
+    def __init__(self, node_id, process, cache, owner):
+        """
+        :param owner: preprocessor, which metrics get hits and misses, they are looked up at call time,
+            so that metrics replaced after compiling are used
+        """
+        self._process = process
+        self._cache = cache
+        self._owner = owner
+        self._hits_name = '{}/cache_hits'.format(node_id)
+        self._misses_name = '{}/cache_misses'.format(node_id)
+
+    def __call__(self, **kwargs):
+        key = hashable_key(kwargs)
+        results = self._cache.get(key)
+        if results is not None:
+            self._owner.metrics.count(self._hits_name)
+            return results
+
+        self._owner.metrics.count(self._misses_name)
+        results = self._process(**kwargs)
+        for data in results.values():
+            if isinstance(data, np.ndarray):
+                data.setflags(write=False)
+        self._cache.put(key, results)
+        return results
 
 
 class CompositePreprocessor(BasePreprocessor):
@@ -9,7 +46,14 @@ class CompositePreprocessor(BasePreprocessor):
     Preprocessor with Keras-like interface for editing data processing pipeline,
     suitable for cases when data preprocessing is interdependent multi-stage.
     """
-    def __init__(self, input_names, output_names=None, *args, **kwargs):
+    def __init__(self, input_names, output_names=None, profile=False, num_threads=0, *args, **kwargs):
+        """
+        :param input_names: names of inputs of graph
+        :param output_names: names of outputs to be returned, everything computed by default
+        :param profile: time nodes and account sizes of their outputs, see profile_report
+        :param num_threads: number of threads running independent branches of graph in parallel,
+            nodes are run one by one on calling thread by default
+        """
         super(CompositePreprocessor, self).__init__(*args, **kwargs)
         self._proc_graph = nx.MultiDiGraph()
 
@@ -17,6 +61,7 @@ class CompositePreprocessor(BasePreprocessor):
         self._graph_heads = {name: 'input_{}'.format(name) for name in input_names}
         self._nodes_ready = {}
         self._processors = {}
+        self._caches = {}
 
         self._output_names = output_names
 
@@ -24,68 +69,190 @@ class CompositePreprocessor(BasePreprocessor):
             self._proc_graph.add_node('input_{}'.format(input_name), name=input_name)
 
         self._op_order = []
+        self._plan = None
+        self._plan_outputs = None
+        self._finalizers = {}
+        self._num_threads = num_threads
+        self._executor = None
+        self._executor_pid = None
+        self._profile = profile
+        self.metrics = Metrics()  # latencies of nodes when profiling and cache hits, collected by iterators
 
-    def process(self, **kwargs):
-        assert len(kwargs) == len(self._input_nodes), 'Not all inputs can be consumed'
-        if self.is_compiled:
-            return self._compiled_process(**kwargs)
+    def compile(self):
+        """
+        Turns graph into flat plan of (node, process, input slots, output slots, slots to free),
+        values are kept in slots (producing node, name), so that every node gets exactly what it was connected to,
+        slots are freed after their last consumer and outputs consumed by nobody are not kept at all.
+        Called on the first process, graph cannot be changed after that without compiling it again
+        """
+        order = [node_id for node_id in nx.topological_sort(self._proc_graph) if node_id in self._processors]
+        if self._output_names is None:
+            final = {name: (node_id, name) for name, node_id in self._graph_heads.items()}
         else:
-            return self._not_compiled_process(**kwargs)
+            missing = [name for name in self._output_names if name not in self._graph_heads]
+            if len(missing) != 0:
+                raise ValueError('Outputs {} are not produced by graph'.format(missing))
+            final = {name: (self._graph_heads[name], name) for name in self._output_names}
 
-    def _compiled_process(self, **kwargs):
-        assert self.is_compiled, 'Graph is not compiled, _compile_process cannot be launched'
-        comp_state = {k: kwargs[k] for k in self._input_nodes.values()}
+        node_inputs = {}
+        for node_id in order:
+            node_inputs[node_id] = tuple((arg_name, (source, arg_name)) for source, _, arg_name
+                                         in self._proc_graph.in_edges(node_id, data='arg_name'))
+            missing = set(self._processors[node_id].provide_input) - set(arg for arg, _ in node_inputs[node_id])
+            if len(missing) != 0:
+                raise ValueError('Inputs {} of {} are not produced by preceding nodes'.format(sorted(missing), node_id))
 
-        for node_id in self._op_order:
-            processor = self._proc_graph.node[node_id]['processor']
-            inp = {name: comp_state[name] for name in processor.provide_input}
-            comp_state.update(processor.process(**inp))
+        last_use = {}
+        for pos, node_id in enumerate(order):
+            for _, slot in node_inputs[node_id]:
+                last_use[slot] = pos
+        kept = set(last_use) | set(final.values())
 
-        return comp_state if self._output_names is None else {name: comp_state[name] for name in self._output_names}
+        plan = []
+        for pos, node_id in enumerate(order):
+            processor = self._processors[node_id]
+            outputs = tuple((name, (node_id, name)) for name in processor.provide_output if (node_id, name) in kept)
+            to_free = tuple(slot for _, slot in node_inputs[node_id]
+                            if last_use[slot] == pos and slot not in final.values())
+            process = processor.process
+            if node_id in self._caches:
+                process = _CachedProcess(node_id, process, self._caches[node_id], self)
+            plan.append((node_id, process, node_inputs[node_id], outputs, tuple(set(to_free))))
 
-    def _not_compiled_process(self, **kwargs):
-        assert not self.is_compiled, 'Graph is already compiled, _no_compile_process cannot be launched'
-        available_data = defaultdict(dict)
+        positions = {node_id: pos for pos, node_id in enumerate(order)}
+        dependents = [[] for _ in order]
+        num_dependencies = []
+        for pos, node_id in enumerate(order):
+            producers = set(positions[source] for _, (source, _) in node_inputs[node_id] if source in positions)
+            for producer in producers:
+                dependents[producer].append(pos)
+            num_dependencies.append(len(producers))
 
-        comp_queue = list(self._input_nodes.keys())
-        comp_state = {k: kwargs[k] for k in self._input_nodes.values()}
+        # deferred outputs reach outputs of graph unfinished through nodes passing them on under the same name,
+        # batches of those outputs are finalized by the deferring node
+        deferred = {}
+        for node_id in order:
+            processor = self._processors[node_id]
+            for arg_name, slot in node_inputs[node_id]:
+                if slot in deferred and arg_name not in processor.provide_output:
+                    raise ValueError('Output {} of {} is deferred to finalize_batch, it cannot be consumed by {}, '
+                                     'which does not pass it on'.format(slot[1], slot[0], node_id))
+            passed = {arg_name: deferred[slot] for arg_name, slot in node_inputs[node_id] if slot in deferred}
+            for name in processor.provide_output:
+                if name in getattr(processor, 'deferred_outputs', ()):
+                    deferred[(node_id, name)] = processor
+                elif name in passed:
+                    deferred[(node_id, name)] = passed[name]
 
-        while len(comp_queue) != 0:
-            node_id = comp_queue.pop(0)
+        self._finalizers = {name: deferred[slot] for name, slot in final.items() if slot in deferred}
+        self._plan = plan
+        self._plan_outputs = tuple(final.items())
+        self._plan_dependents = dependents
+        self._plan_num_dependencies = num_dependencies
+        self._final_slots = set(final.values())
+        self._slot_consumers = {}
+        for _, slot in (item for node_id in order for item in node_inputs[node_id]):
+            self._slot_consumers[slot] = self._slot_consumers.get(slot, 0) + 1
+        self._op_order = order
 
-            if node_id in self._processors:
-                processor = self._proc_graph.node[node_id]['processor']
-                inp = {name: comp_state[name] for name in processor.provide_input}
-                comp_state.update(processor.process(**inp))
+    def _call_node(self, node_id, process, kwargs):
+        if not self._profile:
+            return process(**kwargs)
 
-                self._op_order.append(node_id)
+        start = time.perf_counter()
+        results = process(**kwargs)
+        self.metrics.add(node_id, time.perf_counter() - start)
+        self.metrics.add('{}/output_bytes'.format(node_id), data_nbytes(results), base=1)
+        return results
 
-            for successor in self._proc_graph.successors(node_id):
-                passed_args = self._proc_graph.get_edge_data(node_id, successor)
-                successor_processor = self._proc_graph.node[successor]['processor']
-                if successor not in available_data:
-                    for name in successor_processor.provide_input:
-                        available_data[successor][name] = False
+    def process(self, **kwargs):
+        assert len(kwargs) == len(self._input_nodes), 'Not all inputs can be consumed'
+        if self._plan is None:
+            self.compile()
 
-                for edge_dict in passed_args.values():
-                    arg_name = edge_dict['arg_name']
-                    available_data[successor][arg_name] = True
+        state = {(node_id, name): kwargs[name] for node_id, name in self._input_nodes.items()}
+        if self._num_threads > 0:
+            self._process_parallel(state)
+        else:
+            for node_id, process, inputs, outputs, to_free in self._plan:
+                results = self._call_node(node_id, process, {arg_name: state[slot] for arg_name, slot in inputs})
+                for name, slot in outputs:
+                    state[slot] = results[name]
+                for slot in to_free:
+                    del state[slot]
 
-                if all(available_data[successor].values()):
-                    comp_queue.append(successor)
+        return {name: state[slot] for name, slot in self._plan_outputs}
 
-        return comp_state if self._output_names is None else {name: comp_state[name] for name in self._output_names}
+    def _get_executor(self):
+        # threads do not survive fork, so pool inherited by worker process is replaced
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self._num_threads)
+            self._executor_pid = os.getpid()
+        return self._executor
 
-    def add(self, processor, **kwargs):
+    def _process_parallel(self, state):
+        """
+        Submits nodes to pool as soon as their producers are done, calling thread only schedules them,
+        slots are freed once all their consumers got them
+        """
+        executor = self._get_executor()
+        consumers = dict(self._slot_consumers)
+        num_waiting = list(self._plan_num_dependencies)
+        ready = [pos for pos, num in enumerate(num_waiting) if num == 0]
+        running = {}
+
+        while len(ready) != 0 or len(running) != 0:
+            for pos in ready:
+                node_id, process, inputs, _, _ = self._plan[pos]
+                node_kwargs = {arg_name: state[slot] for arg_name, slot in inputs}
+                for _, slot in inputs:
+                    consumers[slot] -= 1
+                    if consumers[slot] == 0 and slot not in self._final_slots:
+                        state.pop(slot, None)
+                running[executor.submit(self._call_node, node_id, process, node_kwargs)] = pos
+            ready = []
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                pos, results = running.pop(future), future.result()
+                for name, slot in self._plan[pos][3]:
+                    state[slot] = results[name]
+                for dependent in self._plan_dependents[pos]:
+                    num_waiting[dependent] -= 1
+                    if num_waiting[dependent] == 0:
+                        ready.append(dependent)
+
+    def close(self):
+        if self._executor is not None and self._executor_pid == os.getpid():
+            self._executor.shutdown(wait=False)
+        self._executor = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_executor'] = None
+        return state
+
+    def _config_state(self):
+        # what defines outputs of graph for describe_config, compiled plan, executor and caches are left out
+        return {'processors': self._processors, 'edges': sorted(self._proc_graph.edges(data='arg_name')),
+                'input_names': sorted(self._input_nodes.values()), 'output_names': self._output_names}
+
+    def add(self, processor, cache_items=None, cache_bytes=None, **kwargs):
         """
         :param processor: object with method process
+        :param cache_items: max number of outputs of node to be cached, keyed by its input values
+        :param cache_bytes: max size of cached outputs of node, node is cached if any of limits is given,
+            only deterministic nodes are to be cached, their outputs are shared by samples and read only
         """
         proc_name = kwargs.get('name', processor.__class__.__name__)
         if proc_name in self._processors:
-            self.add(processor, name='{}_0'.format(proc_name))
+            self.add(processor, cache_items=cache_items, cache_bytes=cache_bytes, name='{}_0'.format(proc_name))
             return
 
         self._processors[proc_name] = processor
+        if cache_items is not None or cache_bytes is not None:
+            self._caches[proc_name] = LRUCache(max_items=cache_items, max_bytes=cache_bytes)
+        self._plan = None
         self._proc_graph.add_node(proc_name, processor=processor, name=proc_name)
 
         for name in processor.provide_input:
@@ -93,9 +260,88 @@ class CompositePreprocessor(BasePreprocessor):
             self._proc_graph.add_edge(self._graph_heads[name], proc_name, arg_name=name)
         self._graph_heads.update({new_out_name: proc_name for new_out_name in processor.provide_output})
 
+    def finalize_batch(self, name, batch, out=None):
+        if self._plan is None:
+            self.compile()
+        processor = self._finalizers.get(name)
+        if processor is None:
+            return batch
+        return processor.finalize_batch(name, batch, out=out)
+
+    @property
+    def deferred_outputs(self):
+        if self._plan is None:
+            self.compile()
+        return list(self._finalizers)
+
+    def cache_stats(self):
+        """
+        :return: {node: {'hits', 'misses', 'evictions', 'items', 'bytes'}} for cached nodes of this process,
+            hits and misses of all workers are collected by metrics of iterators as well
+        """
+        return {node_id: cache.stats for node_id, cache in self._caches.items()}
+
+    def clear_caches(self):
+        for cache in self._caches.values():
+            cache.clear()
+
+    def profile_report(self, top=5):
+        """
+        :param top: number of heaviest nodes to report
+        :return: dict {'nodes': {node: {'count', 'total', 'mean', 'p50', 'p99'[, 'output_bytes']}},
+                       'critical_path': chain of nodes with the largest sum of mean latencies,
+                       'critical_path_time': the sum, 'heaviest': [(node, total time), ...]},
+            p50 and p99 are estimated by histograms of metrics within 1/8 of their value
+        """
+        histograms = self.metrics.snapshot()['histograms']
+        nodes = {}
+        for node_id in self._processors:
+            stats = histograms.get(node_id, {})
+            nodes[node_id] = {key: stats.get(key, 0.) for key in ('count', 'total', 'mean', 'p50', 'p99')}
+            if '{}/output_bytes'.format(node_id) in histograms:
+                nodes[node_id]['output_bytes'] = histograms['{}/output_bytes'.format(node_id)].get('mean', 0.)
+
+        # longest path through graph weighted by mean latencies of nodes, inputs weigh nothing
+        path_time, path_prev = {}, {}
+        for node_id in nx.topological_sort(self._proc_graph):
+            predecessors = list(self._proc_graph.predecessors(node_id))
+            prev = max(predecessors, key=path_time.get) if len(predecessors) != 0 else None
+            path_time[node_id] = nodes.get(node_id, {}).get('mean', 0.) + (path_time[prev] if prev else 0.)
+            path_prev[node_id] = prev
+
+        path, node_id = [], max(path_time, key=path_time.get)
+        critical_path_time = path_time[node_id]
+        while node_id is not None:
+            path.append(node_id)
+            node_id = path_prev[node_id]
+
+        heaviest = sorted(nodes, key=lambda node: nodes[node]['total'], reverse=True)[:top]
+        return {
+            'nodes': nodes, 'critical_path': [node for node in reversed(path) if node in self._processors],
+            'critical_path_time': critical_path_time, 'heaviest': [(node, nodes[node]['total']) for node in heaviest]
+        }
+
+    def format_profile_report(self, top=5):
+        """
+        :return: profile_report as text table
+        """
+        report = self.profile_report(top=top)
+        lines = ['{:<30} {:>8} {:>10} {:>10} {:>10} {:>12}'.format(
+            'node', 'count', 'total, s', '~p50, ms', '~p99, ms', 'output, KB')]
+        for node_id in self._op_order or sorted(report['nodes']):
+            stats = report['nodes'][node_id]
+            lines.append('{:<30} {:>8} {:>10.3f} {:>10.3f} {:>10.3f} {:>12}'.format(
+                node_id, stats['count'], stats['total'], stats['p50'] * 1e3, stats['p99'] * 1e3,
+                '{:.1f}'.format(stats['output_bytes'] / 1024.) if 'output_bytes' in stats else '-'))
+
+        lines.append('critical path ({:.3f} ms per sample): {}'.format(
+            report['critical_path_time'] * 1e3, ' -> '.join(report['critical_path'])))
+        lines.append('heaviest: {}'.format(', '.join('{} ({:.3f} s)'.format(*item) for item in report['heaviest'])))
+        return '\n'.join(lines)
+
     @property
     def is_compiled(self):
-        return len(self._op_order) != 0
+        return self._plan is not None
 
     @property
     def provide_data(self):
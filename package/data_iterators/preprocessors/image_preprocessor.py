@@ -4,8 +4,10 @@ import logging
 import numpy as np
 import os
 
-from .base_preprocessor import BasePreprocessor, MIMOPreprocessor
+from .base_preprocessor import BasePreprocessor, MIMOPreprocessor, crop_frames, read_array
 from ...data_iterators import TRIAL_DATA_DIR
+from ...io.shards import ShardReader
+from ...transformers.normalization import normalize_transpose
 from ...transformers.resizing import loop_video_size_casting, back_and_fourth_video_size_casting, \
     make_random_beginning_video_size_casting
 
@@ -14,6 +16,25 @@ logger = logging.getLogger('{}.{}'.format(ROOT_LOGGER_NAME, __name__))
 logger.setLevel(ROOT_LOGGER_LEVEL)
 
 
+def read_rgb_image(path, image_cache=None):
+    """
+    :param path: path to image file
+    :param image_cache: LRUCache or SharedArrayCache of decoded images, keyed by path and mtime of file,
+        images taken from LRUCache are read only
+    :return: RGB image in HWC layout
+    """
+    if image_cache is None:
+        return cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB)
+
+    key = (path, os.path.getmtime(path))
+    rgb = image_cache.get(key)
+    if rgb is None:
+        rgb = cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB)
+        rgb.setflags(write=False)
+        image_cache.put(key, rgb)
+    return rgb
+
+
 class RGBImageFromFile(BasePreprocessor):
     """
     Provides a transformed RGB image in CHW layout from file
@@ -21,9 +42,19 @@ class RGBImageFromFile(BasePreprocessor):
     trial_data = os.path.join(TRIAL_DATA_DIR, 'trial_img.jpg')
     layouts_signatures = {'CHW': (2, 0, 1), 'HWC': (0, 1, 2), 'WHC': (0, 2, 1)}
 
-    def __init__(self, image_transformer=None, layout='CHW', norm_mean=(0, 0, 0), norm_std=(1, 1, 1), *args, **kwargs):
+    def __init__(self, image_transformer=None, layout='CHW', norm_mean=(0, 0, 0), norm_std=(1, 1, 1),
+                 image_cache=None, dtype=np.float32, defer_normalization=False, *args, **kwargs):
+        """
+        :param image_cache: LRUCache to keep decoded images in process,
+            or SharedArrayCache to share them by workers of MultiProcessIterator, created before iterator
+        :param dtype: dtype of normalized images, float32 or float16 usually
+        :param defer_normalization: return images as transformed (uint8 HWC, if image_transformer keeps them so),
+            iterators normalize and transpose whole batches with finalize_batch, so that workers of
+            MultiProcessIterator pass uint8 arrays instead of float ones
+        """
         super(RGBImageFromFile, self).__init__(*args, **kwargs)
         self._transform = image_transformer or (lambda x: x)
+        self._image_cache = image_cache
 
         self._shape = self._shape
         self._name = self._name or 'default'
@@ -31,21 +62,47 @@ class RGBImageFromFile(BasePreprocessor):
 
         self._norm_mean = np.array(norm_mean, dtype=float)
         self._norm_std = np.array(norm_std, dtype=float)
+        self._dtype = dtype
+        self._defer_normalization = defer_normalization
+
+    def normalize(self, img, signature, out=None):
+        """
+        :return: img normalized and transposed with signature into contiguous array of dtype,
+            img is returned as is, if normalization is deferred
+        """
+        if self._defer_normalization:
+            return np.asarray(img)
+        return normalize_transpose(img, self._norm_mean, self._norm_std, signature, self._dtype, out=out)
+
+    def finalize_batch(self, name, batch, out=None):
+        if not self._defer_normalization:
+            return batch
+        batch_signature = (0,) + tuple(i + 1 for i in self.layouts_signatures[self._layout])
+        return normalize_transpose(np.asarray(batch), self._norm_mean, self._norm_std, batch_signature, self._dtype,
+                                   out=out)
+
+    @property
+    def deferred_outputs(self):
+        return list(self.provide_output) if self._defer_normalization else []
 
     def process(self, **kwargs):
         processed = {}
         for key, data in kwargs.items():
             rgb = self.get_image_array(data)
             img = self._transform(rgb)
+            processed[key] = self.normalize(img, self.layouts_signatures[self._layout])
+        return processed
 
-            img = (img - self._norm_mean) / self._norm_std
-            img = img.transpose(*self.layouts_signatures[self._layout])
-            processed[key] = img
+    def process_batch(self, **kwargs):
+        batch_signature = (0,) + tuple(i + 1 for i in self.layouts_signatures[self._layout])
+        processed = {}
+        for key, data in kwargs.items():
+            imgs = np.array([self._transform(self.get_image_array(d)) for d in data])
+            processed[key] = self.normalize(imgs, batch_signature)
         return processed
 
     def get_image_array(self, data):
-        rgb = cv2.cvtColor(cv2.imread(data), cv2.COLOR_BGR2RGB)
-        return rgb
+        return read_rgb_image(data, self._image_cache)
 
 
 class RGBImageFromCallable(RGBImageFromFile):
@@ -61,6 +118,8 @@ class RGBImageFromCallable(RGBImageFromFile):
 
 
 class RGBImageFromCallableMIMO(RGBImageFromCallable, MIMOPreprocessor):
+    process_batch = MIMOPreprocessor.process_batch
+
     def __init__(self, input_names, data_shapes, data_names=('image',), *args, **kwargs):
         super(RGBImageFromCallableMIMO, self).__init__(
             input_names=input_names, data_shapes=data_shapes, data_names=data_names, *args, **kwargs
@@ -85,10 +144,7 @@ class RGBImageFromCallableMIMO(RGBImageFromCallable, MIMOPreprocessor):
         rgb = self.get_image_array(data)
         img = self._transform(rgb)
 
-        img = (img - self._norm_mean) / self._norm_std
-        img = img.transpose(*self.layouts_signatures[self._layout])
-
-        processed[self.provide_output[0]] = img
+        processed[self.provide_output[0]] = self.normalize(img, self.layouts_signatures[self._layout])
         return processed
 
 
@@ -97,6 +153,24 @@ class RGBImageFromArray(RGBImageFromFile):
         return data
 
 
+class RGBImageFromShards(RGBImageFromFile):
+    """
+    Provides a transformed RGB image from shards written by io.shards.pack_shards, data is index of image in shards
+    """
+    def __init__(self, prefix, *args, **kwargs):
+        """
+        :param prefix: prefix of shards, encoded images are decoded, arrays are taken as RGB images in HWC layout
+        """
+        super(RGBImageFromShards, self).__init__(*args, **kwargs)
+        self._reader = ShardReader(prefix)
+
+    def get_image_array(self, data):
+        record = self._reader[data]
+        if self._reader.mode == 'array':
+            return record
+        return cv2.cvtColor(cv2.imdecode(record, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+
+
 class RGBImagesFromList(BasePreprocessor):
     """
     Provides a transformed RGB images in CTHW, TCHW layout from list of files
@@ -116,13 +190,22 @@ class RGBImagesFromList(BasePreprocessor):
     trial_data = [os.path.join(TRIAL_DATA_DIR, 'trial_img.jpg')]
 
     def __init__(self, num_frames, mode='interpolate', seq_transformer=None, layout='CTHW',
-                 norm_mean=(0, 0, 0), norm_std=(1, 1, 1), *args, **kwargs):
+                 norm_mean=(0, 0, 0), norm_std=(1, 1, 1), image_cache=None, dtype=np.float32,
+                 defer_normalization=False, *args, **kwargs):
+        """
+        :param image_cache: cache of decoded frames, see RGBImageFromFile
+        :param dtype: dtype of normalized frames, float32 or float16 usually
+        :param defer_normalization: return frames in THWC layout as transformed, see RGBImageFromFile
+        """
         self._num_frames = num_frames
+        self._image_cache = image_cache
         self._interpolation = mode
         self._layout = layout
 
         self._norm_mean = np.array(norm_mean, dtype=float)
         self._norm_std = np.array(norm_std, dtype=float)
+        self._dtype = dtype
+        self._defer_normalization = defer_normalization
 
         super(RGBImagesFromList, self).__init__(*args, **kwargs)
         self._transform = seq_transformer or (lambda x: x)
@@ -131,27 +214,52 @@ class RGBImagesFromList(BasePreprocessor):
         self._name = self._name or 'default'
 
     def get_image_array(self, data):
-        img_arr = []
-        for im_file in data:
-            img = cv2.cvtColor(cv2.imread(im_file), cv2.COLOR_BGR2RGB)
-            img_arr.append(img)
+        return [read_rgb_image(im_file, self._image_cache) for im_file in data]
 
-        return img_arr
+    def get_num_frames(self, data):
+        """
+        :return: number of frames in data, if it is known before reading them, None otherwise
+        """
+        return len(data)
+
+    def read_frames(self, data, frame_indices):
+        """
+        Reads only selected frames, used when get_num_frames is known
+        :param frame_indices: sorted unique indices of frames
+        """
+        return [read_rgb_image(data[num], self._image_cache) for num in frame_indices]
 
     def process(self, **kwargs):
         processed = {}
         for key, data in kwargs.items():
-            inp_img_arr = self.get_image_array(data)
-
-            out_img_arr = self._transform(inp_img_arr)
-            time_slice = self.interpolation_func[self._interpolation](self._num_frames, len(out_img_arr))
-            img_arr = np.array(out_img_arr)[time_slice, :]
+            num_frames = self.get_num_frames(data)
+            if num_frames is None:
+                out_img_arr = self._transform(self.get_image_array(data))
+                time_slice = self.interpolation_func[self._interpolation](self._num_frames, len(out_img_arr))
+                img_arr = np.array(out_img_arr)[time_slice, :]
+            else:
+                # frames are selected before reading, every selected frame is read and transformed once
+                time_slice = self.interpolation_func[self._interpolation](self._num_frames, num_frames)
+                frame_indices, positions = np.unique(time_slice, return_inverse=True)
+                img_arr = np.array(self._transform(self.read_frames(data, frame_indices)))[positions]
+
+            if self._defer_normalization:
+                processed[key] = img_arr
+            else:
+                processed[key] = normalize_transpose(img_arr, self._norm_mean, self._norm_std,
+                                                     self.layouts_signatures[self._layout], self._dtype)
+        return processed
 
-            img_arr = (img_arr - self._norm_mean) / self._norm_std
-            img_arr = img_arr.transpose(*self.layouts_signatures[self._layout])
+    def finalize_batch(self, name, batch, out=None):
+        if not self._defer_normalization:
+            return batch
+        batch_signature = (0,) + tuple(i + 1 for i in self.layouts_signatures[self._layout])
+        return normalize_transpose(np.asarray(batch), self._norm_mean, self._norm_std, batch_signature, self._dtype,
+                                   out=out)
 
-            processed[key] = img_arr
-        return processed
+    @property
+    def deferred_outputs(self):
+        return list(self.provide_output) if self._defer_normalization else []
 
 
 class RGBImagesFromCallable(RGBImagesFromList):
@@ -162,12 +270,49 @@ class RGBImagesFromCallable(RGBImagesFromList):
     def get_image_array(self, data):
         return self._getter(data)
 
+    def get_num_frames(self, data):
+        return None
+
 
 class RGBImagesFromData(RGBImagesFromList):
-    def __init__(self, format_string,  *args, **kwargs):
+    def __init__(self, format_string, crop=None, *args, **kwargs):
+        """
+        :param crop: spatial crop of frames, (top, left, height, width) or function of shape of array returning them
+
+        Files are memory mapped, only frames selected by mode and their crops are read
+        """
         super(RGBImagesFromData, self).__init__(*args, **kwargs)
         self._format_string = format_string
+        self._crop = crop
 
     def get_image_array(self, data):
-        arr = np.load(self._format_string.format(data))
-        return arr
+        return read_array(self._format_string.format(data), crop=self._crop)
+
+    def get_num_frames(self, data):
+        return np.load(self._format_string.format(data), mmap_mode='r').shape[0]
+
+    def read_frames(self, data, frame_indices):
+        return read_array(self._format_string.format(data), frame_indices, self._crop)
+
+
+class RGBImagesFromShards(RGBImagesFromList):
+    """
+    Provides transformed RGB frames from shards of arrays in THWC layout, written by io.shards.pack_shards,
+    data is index of frames in shards
+    """
+    def __init__(self, prefix, crop=None, *args, **kwargs):
+        """
+        :param crop: spatial crop of frames, see RGBImagesFromData
+        """
+        super(RGBImagesFromShards, self).__init__(*args, **kwargs)
+        self._reader = ShardReader(prefix)
+        self._crop = crop
+
+    def get_image_array(self, data):
+        return crop_frames(self._reader[data], self._crop)
+
+    def get_num_frames(self, data):
+        return self._reader.shape[0]
+
+    def read_frames(self, data, frame_indices):
+        return crop_frames(self._reader[data], self._crop)[frame_indices]
@@ -0,0 +1,111 @@
+import os
+import json
+import logging
+
+import numpy as np
+
+from .file_utils import recursive_mkdir
+
+from .. import ROOT_LOGGER_NAME, ROOT_LOGGER_LEVEL
+logger = logging.getLogger('{}.{}'.format(ROOT_LOGGER_NAME, __name__))
+logger.setLevel(ROOT_LOGGER_LEVEL)
+
+# one record of index: number of shard, offset and length of record in it
+INDEX_DTYPE = np.dtype([('shard', '<u4'), ('offset', '<u8'), ('length', '<u8')])
+
+
+def _shard_path(prefix, num):
+    return '{}_{:05d}.bin'.format(prefix, num)
+
+
+def pack_shards(items, prefix, mode='encoded', shard_bytes=1 << 30):
+    """
+    Writes items one after another into shard files prefix_00000.bin, ..., with index prefix.index.npy
+    and description prefix.json, i-th item is read back by ShardReader(prefix)[i]
+    :param items: iterable of paths to files (or bytes) for 'encoded' mode, of arrays of the same shape for 'array' mode,
+        for instance (frame_array_from_video(path) for path in paths)
+    :param prefix: path prefix of files to be written
+    :param mode: 'encoded' to keep bytes of files as is (jpeg, png), 'array' to keep raw uint8 arrays
+    :param shard_bytes: size of shard, after which the next shard is started
+    :return: number of packed items
+    """
+    if mode not in ('encoded', 'array'):
+        raise ValueError('Unknown mode of shards {}'.format(mode))
+    recursive_mkdir(os.path.dirname(os.path.abspath(prefix)))
+
+    index, shape = [], None
+    shard_num, shard_size, shard_file = 0, 0, None
+    try:
+        for item in items:
+            if mode == 'encoded':
+                if not isinstance(item, bytes):
+                    with open(item, 'rb') as f:
+                        item = f.read()
+                record = item
+            else:
+                item = np.asarray(item)
+                if item.dtype != np.uint8:
+                    raise ValueError('Array of dtype {} cannot be packed, arrays are to be of uint8'.format(item.dtype))
+                item = np.ascontiguousarray(item)
+                shape = shape or item.shape
+                if item.shape != shape:
+                    raise ValueError('Array of shape {} cannot be packed with arrays of shape {}'.format(
+                        item.shape, shape))
+                record = item.data.cast('B')
+
+            if shard_file is None or (shard_size != 0 and shard_size + len(record) > shard_bytes):
+                if shard_file is not None:
+                    shard_file.close()
+                    shard_num += 1
+                shard_file, shard_size = open(_shard_path(prefix, shard_num), 'wb'), 0
+
+            shard_file.write(record)
+            index.append((shard_num, shard_size, len(record)))
+            shard_size += len(record)
+    finally:
+        if shard_file is not None:
+            shard_file.close()
+
+    num_shards = shard_num + 1 if shard_file is not None else 0
+    np.save('{}.index.npy'.format(prefix), np.array(index, dtype=INDEX_DTYPE))
+    with open('{}.json'.format(prefix), 'w') as f:
+        json.dump({'mode': mode, 'shape': shape, 'num_shards': num_shards, 'num_items': len(index)}, f)
+    logger.info('{} items packed into {} shards with prefix {}'.format(len(index), num_shards, prefix))
+    return len(index)
+
+
+class ShardReader(object):
+    """
+    Random access to items packed by pack_shards, shards are memory mapped on the first access in every process,
+    items are read only views of mapped shards
+    """
+    def __init__(self, prefix):
+        with open('{}.json'.format(prefix)) as f:
+            description = json.load(f)
+        self.mode = description['mode']
+        self.shape = tuple(description['shape']) if description['shape'] is not None else None
+        self._prefix = prefix
+        self._index = np.load('{}.index.npy'.format(prefix))
+        self._shards = {}
+
+    def __len__(self):
+        return len(self._index)
+
+    def _shard(self, num):
+        shard = self._shards.get(num)
+        if shard is None:
+            shard = self._shards[num] = np.memmap(_shard_path(self._prefix, num), dtype=np.uint8, mode='r')
+        return shard
+
+    def __getitem__(self, item):
+        """
+        :return: uint8 array of encoded bytes in 'encoded' mode, array of packed shape in 'array' mode
+        """
+        shard_num, offset, length = self._index[item]
+        record = self._shard(int(shard_num))[offset:offset + length]
+        return record if self.mode == 'encoded' else record.reshape(self.shape)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
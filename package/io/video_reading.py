@@ -3,6 +3,8 @@ import ffmpeg
 import numpy as np
 import re
 import logging
+import threading
+from collections import deque
 from decimal import Decimal
 
 from .. import ROOT_LOGGER_NAME, ROOT_LOGGER_LEVEL
@@ -36,6 +38,94 @@ def get_fps(path):
     return int(round(fps))
 
 
+def _video_stream_info(video_path):
+    """
+    :return: height, width, fps (0 if unknown), duration in seconds (0 if unknown)
+    """
+    probe = ffmpeg.probe(video_path)
+    video_stream = next((stream for stream in probe['streams'] if stream['codec_type'] == 'video'), None)
+    num, den = video_stream.get('avg_frame_rate', '0/1').split('/')
+    fps = float(num) / float(den) if float(den) != 0 else 0.
+    # duration of stream is often missing in containers like mkv and webm, the one of container is taken then
+    duration = video_stream.get('duration') or probe.get('format', {}).get('duration') or 0.
+    return int(video_stream['height']), int(video_stream['width']), fps, float(duration)
+
+
+def _read_exactly(pipe, view):
+    """
+    Fills view with bytes from pipe
+    :return: False if pipe ended before view is filled
+    """
+    filled = 0
+    while filled < len(view):
+        num_read = pipe.readinto(view[filled:])
+        if not num_read:
+            return False
+        filled += num_read
+    return True
+
+
+def iterate_frames(video_path, ts_start=0., ts_end=None, window=None, step=None):
+    """
+    Decodes video by ffmpeg lazily, reading its output pipe frame by frame into reusable buffer
+    :param video_path: path to video
+    :param ts_start: start timestamp in seconds
+    :param ts_end: end timestamp in seconds, end of video by default
+    :param window: if set, windows of this many consecutive frames are yielded instead of single frames
+    :param step: number of frames between beginnings of consecutive windows, window by default
+    :return: generator of frames (h, w, 3) or windows (window, h, w, 3) of uint8,
+        they are views of buffer valid until the next one is taken, so they are to be copied to be kept,
+        ffmpeg.Error with stderr of ffmpeg is raised at the end, if decoding failed, as by ffmpeg.run
+    """
+    h, w, _, _ = _video_stream_info(video_path)
+    window_size = window or 1
+    step = step or window_size
+    frame_bytes = h * w * 3
+
+    trim_args = {'start': ts_start} if ts_end is None else {'start': ts_start, 'end': ts_end}
+    stream = ffmpeg.trim(stream=ffmpeg.input(video_path), **trim_args)
+    process = stream.output('pipe:', format='rawvideo', pix_fmt='rgb24').run_async(pipe_stdout=True, pipe_stderr=True)
+    # stderr is drained all the time, so that ffmpeg never blocks on it, its tail is kept for errors
+    stderr_tail = deque(maxlen=50)
+    stderr_reader = threading.Thread(target=lambda: stderr_tail.extend(process.stderr), daemon=True)
+    stderr_reader.start()
+
+    buf = np.empty((window_size, h, w, 3), dtype=np.uint8)
+    view = memoryview(buf).cast('B')
+    finished = False
+    try:
+        # the first window is filled completely, every next one shifts by step frames
+        num_new, to_skip = window_size, 0
+        while True:
+            for _ in range(to_skip):
+                if not _read_exactly(process.stdout, view[:frame_bytes]):
+                    finished = True
+                    return
+            start = (window_size - num_new) * frame_bytes
+            if not _read_exactly(process.stdout, view[start:]):
+                finished = True
+                return
+
+            yield buf if window is not None else buf[0]
+
+            num_kept = max(window_size - step, 0)
+            buf[:num_kept] = buf[window_size - num_kept:]
+            num_new, to_skip = window_size - num_kept, max(step - window_size, 0)
+    finally:
+        process.stdout.close()
+        if not finished and process.poll() is None:
+            # generator is closed before the end of video
+            process.kill()
+        return_code = process.wait()
+        stderr_reader.join()
+        process.stderr.close()
+        # decoding errors are raised as by ffmpeg.run, frames read before them are not a whole video
+        if finished and return_code != 0:
+            stderr = b''.join(stderr_tail)
+            logger.error('ffmpeg failed to decode {}: {}'.format(video_path, stderr.decode(errors='replace')))
+            raise ffmpeg.Error('ffmpeg', None, stderr)
+
+
 def frame_array_from_video(video_path, ts_start=0., ts_end=None, drop_frames_fps=None):
     """
     :param video_path: path to video
@@ -45,18 +135,22 @@ def frame_array_from_video(video_path, ts_start=0., ts_end=None, drop_frames_fps
     :return: array of shape (t, h, w, 3)
     """
     logger.debug('read {}'.format(video_path))
-    ts_end = ts_end or get_video_length(video_path)
-
-    probe = ffmpeg.probe(video_path)
-    video_stream = next((stream for stream in probe['streams'] if stream['codec_type'] == 'video'), None)
-    w = int(video_stream['width'])
-    h = int(video_stream['height'])
-
-    stream = ffmpeg.input(video_path)
 
-    stream = ffmpeg.trim(stream=stream, start=ts_start, end=ts_end)
-    out, _ = stream.output('pipe:', format='rawvideo', pix_fmt='rgb24').run(capture_stdout=True)
-    video = np.frombuffer(out, np.uint8).reshape([-1, h, w, 3])
+    # frames are copied into array allocated for the expected number of frames,
+    # it is resized in place by realloc, which grows and shrinks large allocations without copying them
+    h, w, fps, duration = _video_stream_info(video_path)
+    ts_end_known = ts_end or duration
+    expected = int((ts_end_known - ts_start) * fps) + 1 if fps > 0 and ts_end_known > ts_start else 256
+    video = np.empty((max(expected, 1), h, w, 3), dtype=np.uint8)
+
+    num_frames = 0
+    for frame in iterate_frames(video_path, ts_start=ts_start, ts_end=ts_end):
+        if num_frames == len(video):
+            video.resize((len(video) + max(len(video) // 2, 1), h, w, 3), refcheck=False)
+        video[num_frames] = frame
+        num_frames += 1
+    if num_frames != len(video):
+        video.resize((num_frames, h, w, 3), refcheck=False)
 
     if drop_frames_fps is not None:
         fps = get_fps(video_path)
@@ -1,3 +1,9 @@
+import sys
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
 import logging
 
 from .. import ROOT_LOGGER_NAME, ROOT_LOGGER_LEVEL
@@ -14,3 +20,110 @@ def merge_dicts(*dict_args):
     for dictionary in dict_args:
         result.update(dictionary)
     return result
+
+
+def data_nbytes(data):
+    """
+    :return: number of bytes taken by arrays in data, nested dicts, lists and tuples are summed up
+    """
+    if isinstance(data, np.ndarray):
+        return data.nbytes
+    if isinstance(data, dict):
+        return sum(data_nbytes(item) for item in data.values())
+    if isinstance(data, (list, tuple)):
+        return sum(data_nbytes(item) for item in data)
+    return sys.getsizeof(data)
+
+
+def hashable_key(data):
+    """
+    :return: hashable equivalent of data, arrays are replaced with digests of their contents
+    """
+    if isinstance(data, np.ndarray):
+        return 'ndarray', data.dtype.str, data.shape, hashlib.sha1(np.ascontiguousarray(data)).hexdigest()
+    if isinstance(data, dict):
+        return tuple((key, hashable_key(item)) for key, item in sorted(data.items()))
+    if isinstance(data, (list, tuple)):
+        return tuple(hashable_key(item) for item in data)
+    return data
+
+
+class LRUCache(object):
+    """
+    Thread safe mapping bounded by number of items and/or their total size,
+    least recently used items are evicted first
+    """
+    def __init__(self, max_items=None, max_bytes=None, sizeof=data_nbytes):
+        """
+        :param max_items: max number of items, unbounded if None
+        :param max_bytes: max total size of items, unbounded if None
+        :param sizeof: function returning size of item in bytes
+        """
+        self._max_items = max_items
+        self._max_bytes = max_bytes
+        self._sizeof = sizeof
+
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._items.move_to_end(key)
+            return self._items[key][0]
+
+    def put(self, key, value):
+        """
+        Stores value, items not fitting into max_bytes at all are not stored
+        """
+        nbytes = self._sizeof(value)
+        if self._max_bytes is not None and nbytes > self._max_bytes:
+            return
+
+        with self._lock:
+            if key in self._items:
+                self._bytes -= self._items.pop(key)[1]
+            self._items[key] = (value, nbytes)
+            self._bytes += nbytes
+
+            while (self._max_items is not None and len(self._items) > self._max_items) or \
+                    (self._max_bytes is not None and self._bytes > self._max_bytes):
+                self._bytes -= self._items.popitem(last=False)[1][1]
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def stats(self):
+        """
+        :return: dict with hits, misses, evictions, number of items and their size
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'items': len(self._items), 'bytes': self._bytes}
+
+    def __getstate__(self):
+        with self._lock:
+            state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
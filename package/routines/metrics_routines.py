@@ -0,0 +1,165 @@
+import math
+import time
+import threading
+
+
+class Histogram(object):
+    """
+    Histogram of non-negative values (latencies in seconds, queue depths) over octaves split into sub-buckets,
+    cheap to update and to merge, quantiles are estimated by interpolation within buckets,
+    their relative error is below 1 / sub_buckets
+    """
+    def __init__(self, base=1e-6, num_octaves=40, sub_buckets=8):
+        """
+        :param base: upper bound of the first bucket, holding values below it,
+            the i-th octave holds values in [base * 2^(i-1), base * 2^i)
+        :param num_octaves: number of octaves, the last one takes everything above
+        :param sub_buckets: number of equal buckets every octave is split into
+        """
+        self.base = base
+        self.num_octaves = num_octaves
+        self.sub_buckets = sub_buckets
+        self.buckets = [0] * (1 + num_octaves * sub_buckets)
+        self.count = 0
+        self.total = 0.
+        self.min = float('inf')
+        self.max = 0.
+
+    def _bucket(self, value):
+        if value < self.base:
+            return 0
+        # value / base = mantissa * 2^exponent, mantissa in [0.5, 1), which gives octave and sub-bucket
+        mantissa, exponent = math.frexp(value / self.base)
+        bucket = 1 + (exponent - 1) * self.sub_buckets + int((mantissa - 0.5) * 2 * self.sub_buckets)
+        return min(bucket, len(self.buckets) - 1)
+
+    def _bounds(self, bucket):
+        if bucket == 0:
+            return 0., self.base
+        octave, sub_bucket = divmod(bucket - 1, self.sub_buckets)
+        width = self.base * 2 ** octave / self.sub_buckets
+        return self.base * 2 ** octave + width * sub_bucket, self.base * 2 ** octave + width * (sub_bucket + 1)
+
+    def add(self, value, count=1):
+        self.buckets[self._bucket(value)] += count
+        self.count += count
+        self.total += value * count
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        assert (self.base, self.num_octaves, self.sub_buckets) == (other.base, other.num_octaves, other.sub_buckets), \
+            'Histograms with different buckets cannot be merged'
+        for bucket, count in enumerate(other.buckets):
+            self.buckets[bucket] += count
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        """
+        :return: estimate of q-quantile, interpolated linearly within its bucket and clipped by min and max
+        """
+        to_pass = q * self.count
+        for bucket, count in enumerate(self.buckets):
+            if count != 0 and to_pass <= count:
+                lower, upper = self._bounds(bucket)
+                estimate = lower + (upper - lower) * to_pass / count
+                return min(max(estimate, self.min), self.max)
+            to_pass -= count
+        return self.max
+
+    def snapshot(self):
+        if self.count == 0:
+            return {'count': 0}
+        return {
+            'count': self.count, 'total': self.total, 'mean': self.total / self.count,
+            'min': self.min, 'max': self.max,
+            'p50': self.quantile(0.5), 'p90': self.quantile(0.9), 'p99': self.quantile(0.99)
+        }
+
+
+class Metrics(object):
+    """
+    Thread safe registry of named histograms and counters, its snapshot is a plain dict
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._start = time.time()
+
+    def add(self, name, value, base=1e-6, count=1):
+        """
+        Adds value to histogram, which is created with given base on the first call
+        :param count: number of times value is added, e.g. mean latency of count samples
+        """
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram(base=base)
+            histogram.add(value, count)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def merge(self, other, prefix=''):
+        """
+        :param other: Metrics, its values are added with names prefixed
+        """
+        with other._lock:
+            histograms, counters = list(other._histograms.items()), list(other._counters.items())
+
+        with self._lock:
+            for name, other_histogram in histograms:
+                histogram = self._histograms.get(prefix + name)
+                if histogram is None:
+                    histogram = self._histograms[prefix + name] = Histogram(
+                        base=other_histogram.base, num_octaves=other_histogram.num_octaves,
+                        sub_buckets=other_histogram.sub_buckets)
+                histogram.merge(other_histogram)
+            for name, value in counters:
+                self._counters[prefix + name] = self._counters.get(prefix + name, 0) + value
+
+    def pop(self):
+        """
+        :return: Metrics with everything collected so far, this registry is emptied
+        """
+        popped = Metrics()
+        with self._lock:
+            popped._histograms, self._histograms = self._histograms, {}
+            popped._counters, self._counters = self._counters, {}
+        return popped
+
+    def reset(self):
+        self.pop()
+        self._start = time.time()
+
+    @property
+    def elapsed(self):
+        return time.time() - self._start
+
+    def __getstate__(self):
+        with self._lock:
+            return {'histograms': self._histograms, 'counters': self._counters, 'start': self._start}
+
+    def __setstate__(self, state):
+        self._lock = threading.Lock()
+        self._histograms, self._counters, self._start = state['histograms'], state['counters'], state['start']
+
+    def snapshot(self):
+        """
+        :return: dict {'elapsed': seconds since creation or reset, 'counters': {name: value},
+                       'histograms': {name: {'count', 'total', 'mean', 'min', 'max', 'p50', 'p90', 'p99'}}},
+                 quantiles are estimates, see Histogram
+        """
+        with self._lock:
+            return {
+                'elapsed': self.elapsed,
+                'counters': dict(self._counters),
+                'histograms': {name: histogram.snapshot() for name, histogram in self._histograms.items()}
+            }
@@ -1,5 +1,126 @@
+import os
+import uuid
+import fcntl
+import hashlib
+import weakref
+import tempfile
+import threading
+import contextlib
 import multiprocessing as mp
+from multiprocessing import shared_memory, resource_tracker
+
 import numpy as np
+from queue import Full, Empty
+
+
+def _release_shared_memory(shm, owner_pid):
+    shm.close()
+    if os.getpid() == owner_pid:
+        shm.unlink()
+
+
+def _unlink_segment(name):
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+
+def _cache_segment_name(prefix, token):
+    return '{}_{:x}'.format(prefix, token)
+
+
+@contextlib.contextmanager
+def _process_lock(process_locks, lock_path):
+    """
+    Lock of threads of process together with lock of file, which is released by kernel, when its holder dies
+    :param process_locks: {pid: (lock of threads, descriptor of lock file)}, descriptors are opened by every process
+        and never closed, since closing any descriptor of file drops all locks of process on it
+    """
+    pid = os.getpid()
+    lock = process_locks.get(pid)
+    if lock is None:
+        lock = process_locks.setdefault(pid, (threading.Lock(), os.open(lock_path, os.O_RDWR)))
+    thread_lock, fd = lock
+    with thread_lock:
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN)
+
+
+def _release_cached_segments(process_locks, lock_path, index, prefix, owner_pid):
+    if os.getpid() != owner_pid:
+        return
+    with _process_lock(process_locks, lock_path):
+        for row in np.flatnonzero(index[1:, SharedArrayCache.KEY] != 0) + 1:
+            _unlink_segment(_cache_segment_name(prefix, index[row, SharedArrayCache.TOKEN]))
+            index[row, SharedArrayCache.KEY] = 0
+    os.unlink(lock_path)
+
+
+class SharedNDArray(object):
+    """numpy array backed by a shared memory segment, pickled by segment name instead of data"""
+    def __init__(self, shape, dtype, name=None):
+        """
+        :param shape: shape of array
+        :param dtype: dtype of array
+        :param name: name of existing segment to attach to, new segment is created if None
+        """
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+
+        nbytes = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+        self._owner_pid = os.getpid() if name is None else None
+        self._shm = shared_memory.SharedMemory(name=name, create=name is None, size=nbytes)
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self._shm.buf)
+        self._finalizer = weakref.finalize(self, _release_shared_memory, self._shm, self._owner_pid)
+
+    @classmethod
+    def from_array(cls, arr):
+        shared = cls(arr.shape, arr.dtype)
+        shared.array[...] = arr
+        return shared
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    def close(self):
+        self._finalizer()
+
+    def __getstate__(self):
+        return {'shape': self.shape, 'dtype': self.dtype, 'name': self.name}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+class ArrayLease(object):
+    """Items of one ArrayDictQueue slot, arrays are views of the slot until lease is released"""
+    def __init__(self, queue, array_id, items):
+        self._queue = queue
+        self._array_id = array_id
+        self.items = items
+
+    @property
+    def released(self):
+        return self._array_id is None
+
+    def release(self):
+        if self._array_id is not None:
+            # put the shared-memory array back into the pool
+            self._queue.release(self._array_id)
+            self._array_id = None
+
+    def __enter__(self):
+        return self.items
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
 
 
 class ArrayDictQueue(object):
@@ -9,69 +130,300 @@ class ArrayDictQueue(object):
             raise ValueError('ArrayQueue(template, maxsize) must use a finite value for maxsize.')
 
         # find the size and data type for the arrays
-        # note: every ndarray put on the queue must be this size
+        # note: every ndarray put on the queue must fit in this size and be castable to this type
         self.dtypes = {name: template.dtype for name, template in templates.items()}
         self.shapes = {name: template.shape for name, template in templates.items()}
         self.byte_counts = {name: template.size * template.itemsize for name, template in templates.items()}
 
-        self.template_names = templates.keys()
+        self.template_names = list(templates.keys())
+        self.maxsize = maxsize
         # make a pool of numpy arrays, each backed by shared memory,
         # and create a queue to keep track of which ones are free
-        self.array_pool = {name: [None] * maxsize for name in self.template_names}
+        self.slots = {name: SharedNDArray((maxsize,) + self.shapes[name], self.dtypes[name])
+                      for name in self.template_names}
+        self._make_pool()
+
         self.free_arrays = mp.Queue(maxsize)
         for array_id in range(maxsize):
-            for name in self.template_names:
-                dtype, shape, byte_count = self.dtypes[name], self.shapes[name], self.byte_counts[name]
-
-                buf = mp.Array('c', byte_count, lock=False)
-                self.array_pool[name][array_id] = np.frombuffer(buf, dtype=dtype).reshape(shape)
             self.free_arrays.put(array_id)
 
         self.q = mp.Queue(maxsize)
 
-    def put(self, items, *args, **kwargs):
-        dict_to_put = {}
+    def _make_pool(self):
+        self.array_pool = {name: list(self.slots[name].array) for name in self.template_names}
+
+    def put(self, items, block=True, timeout=None):
+        dict_to_put = {'__shapes__': {}}
         # get the ID of an available shared-memory array
-        free_id = self.free_arrays.get()
-
-        for name, item in items.items():
-            if type(item) is np.ndarray and name in self.template_names:
-                dt, shape, byte_count = self.dtypes[name], self.shapes[name], self.byte_counts[name]
-
-                item_size = item.size * item.itemsize
-                if item.dtype == dt and item.shape == shape and item_size == byte_count:
-                    # copy item to the shared-memory array
-                    self.array_pool[name][free_id][:] = item
-                    # put the array's free_id (not the whole array) onto the queue
-                    # dict_to_put[name] = free_id
+        try:
+            free_id = self.free_arrays.get(block, timeout)
+        except Empty:
+            raise Full
+
+        try:
+            for name, item in items.items():
+                if isinstance(item, np.ndarray) and name in self.template_names:
+                    dt, shape, byte_count = self.dtypes[name], self.shapes[name], self.byte_counts[name]
+
+                    item_size = item.size * dt.itemsize
+                    if np.can_cast(item.dtype, dt, 'same_kind') and item.shape[1:] == shape[1:] \
+                            and item_size <= byte_count:
+                        # copy item to the shared-memory array, leading dimension may be shorter than template's
+                        self.array_pool[name][free_id][:item.shape[0]] = item
+                        dict_to_put['__shapes__'][name] = item.shape
+                    else:
+                        raise ValueError(
+                            'ndarray does not match type or shape of template used to initialize ArrayQueue'
+                        )
                 else:
-                    raise ValueError(
-                        'ndarray does not match type or shape of template used to initialize ArrayQueue'
-                    )
-            else:
-                dict_to_put[name] = item
-        dict_to_put['__array_id__'] = free_id
-        self.q.put(dict_to_put, *args, **kwargs)
+                    dict_to_put[name] = item
+            dict_to_put['__array_id__'] = free_id
+            self.q.put(dict_to_put, block, timeout)
+        except (ValueError, Full):
+            self.release(free_id)
+            raise
+
+    def put_nowait(self, items):
+        return self.put(items, False)
 
-    def get(self, *args, **kwargs):
-        items = self.q.get(*args, **kwargs)  # *args, **kwargs are important
+    def lease(self, block=True, timeout=None):
+        """
+        Takes next items from queue without copying arrays,
+        slot is not reused until returned lease is released
+        """
+        items = self.q.get(block, timeout)
+        array_id = items['__array_id__']
         ret_items = {}
         for q_name, item in items.items():
             if q_name == '__array_id__':
-                for name in self.template_names:
+                for name, shape in items['__shapes__'].items():
                     # item is the id of a shared-memory array
-                    # copy the array
-                    arr = self.array_pool[name][item].copy()
-                    ret_items[name] = arr
-            else:
+                    ret_items[name] = self.array_pool[name][item][:shape[0]]
+            elif q_name != '__shapes__':
                 ret_items[q_name] = item
-        # put the shared-memory array back into the pool
-        self.free_arrays.put(items['__array_id__'])
 
-        return ret_items
+        return ArrayLease(self, array_id, ret_items)
+
+    def lease_nowait(self):
+        return self.lease(False)
+
+    def get(self, block=True, timeout=None):
+        with self.lease(block, timeout) as items:
+            return {name: item.copy() if name in self.template_names else item for name, item in items.items()}
 
     def get_nowait(self):
-        raise NotImplementedError
+        return self.get(False)
+
+    def release(self, array_id):
+        self.free_arrays.put(array_id)
+
+    def qsize(self):
+        return self.q.qsize()
+
+    def cancel_join_thread(self):
+        """
+        Lets process exit without flushing queues, for queue abandoned by its readers
+        """
+        self.free_arrays.cancel_join_thread()
+        self.q.cancel_join_thread()
+
+    def close(self):
+        for slot in self.slots.values():
+            slot.close()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['array_pool']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._make_pool()
+
+
+class BatchSlabs(object):
+    """
+    Several batch-shaped arrays per output in shared memory,
+    workers write processed samples straight into their rows of a slab
+    """
+    def __init__(self, templates, batch_size, num_slabs):
+        """
+        :param templates: dict {name: array with shape and dtype of one sample}
+        :param batch_size: number of rows in slab
+        :param num_slabs: number of slabs
+        """
+        self.batch_size = batch_size
+        self.num_slabs = num_slabs
+        self.arrays = {
+            name: SharedNDArray((num_slabs, batch_size) + template.shape, template.dtype)
+            for name, template in templates.items()
+        }
+
+    def write(self, slab, rows, items):
+        """
+        :param slab: slab id
+        :param rows: list of destination rows
+        :param items: dict {name: stacked array or list of samples, aligned with rows}
+        """
+        for name, data in items.items():
+            slab_arr = self.arrays[name].array[slab]
+            if isinstance(data, np.ndarray):
+                slab_arr[rows] = data
+            else:
+                for row, item in zip(rows, data):
+                    slab_arr[row] = item
+
+    def batch(self, slab, rows=None):
+        """
+        :return: dict {name: view of slab} if rows is None, else {name: copy of given rows}
+        """
+        if rows is None:
+            return {name: shared.array[slab] for name, shared in self.arrays.items()}
+        return {name: shared.array[slab][rows] for name, shared in self.arrays.items()}
+
+    def close(self):
+        for shared in self.arrays.values():
+            shared.close()
+
+
+class SharedArrayCache(object):
+    """
+    LRU cache of arrays shared by processes forked after its creation, every array is stored once
+    in its own shared memory segment, index of segments is kept in shared memory as well.
+    Interface is the one of LRUCache: get returns private copy of cached array, put copies array into cache.
+    Index is guarded by lock of file, which is released by kernel, when process holding it is killed,
+    arrays are copied outside of lock, so that lock is held only for reading and updating index
+    """
+    dtypes = ('bool', 'uint8', 'int8', 'uint16', 'int16', 'int32', 'int64', 'float16', 'float32', 'float64')
+    max_ndim = 4
+    # columns of index rows, row 0 keeps counters: clock, hits, misses, evictions, bytes
+    KEY, NBYTES, LAST_USED, TOKEN, DTYPE, NDIM, SHAPE = range(7)
+
+    def __init__(self, max_bytes, max_items=4096):
+        """
+        :param max_bytes: max total size of cached arrays
+        :param max_items: max number of cached arrays, size of index
+        """
+        self._max_bytes = max_bytes
+        self._raw_index = mp.RawArray('q', (max_items + 1) * (self.SHAPE + self.max_ndim))
+        self._index = np.frombuffer(self._raw_index, dtype=np.int64).reshape(max_items + 1, -1)
+
+        self._prefix = 'dpc_{}'.format(uuid.uuid4().hex[:12])
+        self._lock_path = os.path.join(tempfile.gettempdir(), '{}.lock'.format(self._prefix))
+        os.close(os.open(self._lock_path, os.O_RDWR | os.O_CREAT))
+        self._process_locks = {}
+        # segments are made by workers, they must be tracked by the tracker shared with the creator of cache
+        resource_tracker.ensure_running()
+        self._owner_pid = os.getpid()
+        self._finalizer = weakref.finalize(self, _release_cached_segments, self._process_locks, self._lock_path,
+                                           self._index, self._prefix, self._owner_pid)
+
+    def _locked(self):
+        return _process_lock(self._process_locks, self._lock_path)
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.sha1(repr(key).encode()).hexdigest()[:15], 16) or 1
+
+    def _find(self, key_hash):
+        rows = np.flatnonzero(self._index[1:, self.KEY] == key_hash)
+        return rows[0] + 1 if len(rows) != 0 else None
+
+    def _evict(self, row):
+        entry = self._index[row]
+        entry[self.KEY] = 0
+        _unlink_segment(_cache_segment_name(self._prefix, entry[self.TOKEN]))
+        self._index[0, 4] -= entry[self.NBYTES]
+        self._index[0, 3] += 1
+
+    def get(self, key, default=None):
+        with self._locked():
+            row = self._find(self._hash(key))
+            if row is None:
+                self._index[0, 2] += 1
+                return default
+
+            entry = self._index[row]
+            self._index[0, 0] += 1
+            self._index[0, 1] += 1
+            entry[self.LAST_USED] = self._index[0, 0]
+            shape = tuple(entry[self.SHAPE:self.SHAPE + entry[self.NDIM]])
+            dtype = self.dtypes[entry[self.DTYPE]]
+            # once attached, segment stays readable, even if it is evicted by other process
+            shm = shared_memory.SharedMemory(name=_cache_segment_name(self._prefix, entry[self.TOKEN]))
+
+        view = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        arr = view.copy()
+        del view
+        shm.close()
+        return arr
+
+    def put(self, key, value):
+        """
+        Stores array, arrays of other dtypes, with more dimensions or larger than max_bytes are not stored
+        """
+        value = np.ascontiguousarray(value)
+        if value.dtype.name not in self.dtypes or value.ndim > self.max_ndim or value.nbytes > self._max_bytes:
+            return
+
+        key_hash = self._hash(key)
+        with self._locked():
+            if self._find(key_hash) is not None:
+                return
+
+        # segment is made and filled outside of lock, it is published in index afterwards,
+        # segment of process killed before publishing is removed by resource tracker at the end
+        token = int.from_bytes(os.urandom(8), 'little') >> 1
+        name = _cache_segment_name(self._prefix, token)
+        shm = shared_memory.SharedMemory(name=name, create=True, size=max(value.nbytes, 1))
+        view = np.ndarray(value.shape, dtype=value.dtype, buffer=shm.buf)
+        view[...] = value
+        del view
+        shm.close()
+
+        with self._locked():
+            if self._find(key_hash) is not None:
+                # put by other process meanwhile
+                _unlink_segment(name)
+                return
+
+            while True:
+                free = np.flatnonzero(self._index[1:, self.KEY] == 0)
+                if len(free) != 0 and self._index[0, 4] + value.nbytes <= self._max_bytes:
+                    break
+                used = np.flatnonzero(self._index[1:, self.KEY] != 0) + 1
+                self._evict(used[np.argmin(self._index[used, self.LAST_USED])])
+
+            entry = self._index[free[0] + 1]
+            self._index[0, 0] += 1
+            self._index[0, 4] += value.nbytes
+            entry[self.NBYTES] = value.nbytes
+            entry[self.LAST_USED] = self._index[0, 0]
+            entry[self.TOKEN] = token
+            entry[self.DTYPE] = self.dtypes.index(value.dtype.name)
+            entry[self.NDIM] = value.ndim
+            entry[self.SHAPE:self.SHAPE + value.ndim] = value.shape
+            entry[self.KEY] = key_hash
+
+    def clear(self):
+        with self._locked():
+            for row in np.flatnonzero(self._index[1:, self.KEY] != 0) + 1:
+                self._evict(row)
+
+    def __len__(self):
+        return int(np.count_nonzero(self._index[1:, self.KEY]))
+
+    @property
+    def stats(self):
+        """
+        :return: dict with hits, misses, evictions, number of items and their size, summed over processes
+        """
+        with self._locked():
+            _, hits, misses, evictions, nbytes = (int(value) for value in self._index[0, :5])
+            return {'hits': hits, 'misses': misses, 'evictions': evictions, 'items': len(self), 'bytes': nbytes}
 
-    def put_nowait(self):
-        raise NotImplementedError
+    def close(self):
+        """
+        Removes cached segments, is to be called by process, which created cache
+        """
+        self._finalizer()
@@ -0,0 +1,46 @@
+import sys
+import random
+from contextlib import contextmanager
+
+import numpy as np
+
+
+def derive_seed(seed, epoch, index):
+    """
+    Derives seed of one sample, independent of the order in which samples are processed
+    :param seed: base seed
+    :param epoch: epoch number
+    :param index: sample index, int or sequence of ints (as given by sequence balancers)
+    :return: 32 bit seed
+    """
+    entropy = [seed, epoch] + np.asarray(index, dtype=np.int64).ravel().tolist()
+    return int(np.random.SeedSequence(entropy).generate_state(1)[0])
+
+
+def seed_global_random(seed):
+    """
+    Seeds global generators of numpy and random (and imgaug, if it is imported)
+    :param seed: 32 bit seed
+    """
+    np.random.seed(seed)
+    random.seed(seed)
+
+    imgaug = sys.modules.get('imgaug')
+    if imgaug is not None:
+        imgaug.seed(seed)
+
+
+@contextmanager
+def seeded_random_state(seed):
+    """
+    Seeds global generators of numpy and random (and imgaug, if it is imported) for the enclosed code,
+    numpy and random states are restored on exit
+    """
+    np_state, py_state = np.random.get_state(), random.getstate()
+    seed_global_random(seed)
+
+    try:
+        yield
+    finally:
+        np.random.set_state(np_state)
+        random.setstate(py_state)
@@ -0,0 +1,60 @@
+import numpy as np
+import logging
+
+from .. import ROOT_LOGGER_NAME, ROOT_LOGGER_LEVEL
+logger = logging.getLogger('{}.{}'.format(ROOT_LOGGER_NAME, __name__))
+logger.setLevel(ROOT_LOGGER_LEVEL)
+
+
+def _scale_shift(src, scale, shift, dst, compute_dtype, buf=None):
+    if dst.dtype != compute_dtype:
+        buf = np.empty(src.shape, dtype=compute_dtype) if buf is None else buf
+        _scale_shift(src, scale, shift, buf, compute_dtype)
+        dst[...] = buf
+        return
+    np.multiply(src, scale, out=dst, casting='unsafe')
+    np.add(dst, shift, out=dst)
+
+
+def normalize_transpose(arr, mean, std, axes=None, dtype=np.float32, out=None):
+    """
+    Computes ((arr - mean) / std).transpose(axes) straight into contiguous array of dtype,
+    plane by plane, without float64 temporaries
+    :param arr: images with channels on the last axis: HWC, THWC, NHWC, NTHWC, uint8 or float
+    :param mean: mean of every channel or one for all
+    :param std: std of every channel or one for all
+    :param axes: permutation of axes of arr giving layout of output, layout of arr by default
+    :param dtype: dtype of output, float32 or float16 usually
+    :param out: destination of output shape, new array by default
+    :return: out
+    """
+    arr = np.asarray(arr)
+    axes = tuple(range(arr.ndim)) if axes is None else tuple(axes)
+    out_shape = tuple(arr.shape[axis] for axis in axes)
+    if out is None:
+        out = np.empty(out_shape, dtype=dtype)
+    elif out.shape != out_shape:
+        raise ValueError('out of shape {} is given for output of shape {}'.format(out.shape, out_shape))
+
+    # arithmetic of numpy in float16 is emulated, so it is done in float32 and only the result is cast
+    compute_dtype = out.dtype if out.dtype in (np.float32, np.float64) else np.dtype(np.float32)
+    num_channels = arr.shape[-1]
+    inv_std = 1. / np.broadcast_to(np.asarray(std, dtype=float), (num_channels,))
+    scale = inv_std.astype(compute_dtype)
+    shift = (-np.broadcast_to(np.asarray(mean, dtype=float), (num_channels,)) * inv_std).astype(compute_dtype)
+
+    # out viewed in layout of arr
+    view = out.transpose(np.argsort(axes))
+    if arr.ndim < 3 or axes[-1] == arr.ndim - 1:
+        # channels stay the last axis, whole array is processed at once
+        _scale_shift(arr, scale, shift, view, compute_dtype)
+        return out
+
+    # every HW plane of every channel is written at once, it stays in cache between multiplication and addition
+    buf = None if compute_dtype == out.dtype else np.empty(arr.shape[-3:-1], dtype=compute_dtype)
+    for lead in np.ndindex(*arr.shape[:-3]):
+        for channel in range(num_channels):
+            _scale_shift(arr[lead + (Ellipsis, channel)], scale[channel], shift[channel],
+                         view[lead + (Ellipsis, channel)], compute_dtype, buf)
+    return out
+
@@ -53,16 +53,16 @@ def resize_frame_keep_aspect(img, target_size=(500, 500)):
 
 def loop_video_size_casting(num_frames_param, num_frames):
     base_range = np.arange(0, num_frames)
-    num_ranges_whole = num_frames_param / num_frames
+    num_ranges_whole = num_frames_param // num_frames
     linspace_res = num_frames_param % num_frames
 
-    ret_linspace = np.concatenate(num_ranges_whole * [base_range] + base_range[:linspace_res])
+    ret_linspace = np.concatenate(num_ranges_whole * [base_range] + [base_range[:linspace_res]])
     return ret_linspace
 
 
 def back_and_fourth_video_size_casting(num_frames_param, num_frames):
     base_linspace = np.arange(0, num_frames)
-    num_range_whole = num_frames_param / num_frames
+    num_range_whole = num_frames_param // num_frames
     range_res = num_frames_param % num_frames
 
     list_to_cat = []
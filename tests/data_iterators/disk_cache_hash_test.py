@@ -0,0 +1,62 @@
+import os
+import sys
+import subprocess
+import tempfile
+
+import numpy as np
+
+from package.data_iterators.preprocessors.cached_preprocessor import DiskCachedPreprocessor
+from package.data_iterators.preprocessors.composite_preprocessor import CompositePreprocessor
+from package.data_iterators.preprocessors.image_preprocessor import RGBImageFromArray
+from package.data_iterators.preprocessors.base_preprocessor import ArrayTransformer
+
+
+SIZE = 112
+
+
+def transform(img):
+    return np.stack([img[..., c] for c in (2, 1, 0) if c in {0, 1, 2}], axis=-1)
+
+
+def resize(img):
+    return np.resize(img, (SIZE, SIZE, 3))
+
+
+def config_hashes(cache_dir):
+    image = DiskCachedPreprocessor(RGBImageFromArray(image_transformer=transform, name='image'), cache_dir)
+
+    graph = CompositePreprocessor(input_names=['image'])
+    graph.add(RGBImageFromArray(image_transformer=transform, name='image', layout='HWC'))
+    graph.add(ArrayTransformer(transformer=lambda x: x[::-1], name='image'))
+    composite = DiskCachedPreprocessor(graph, cache_dir)
+    before = composite.config_hash
+    graph.process(image=np.zeros((4, 4, 3), dtype=np.uint8))
+    after = DiskCachedPreprocessor(graph, cache_dir).config_hash
+    assert before == after, 'Hash of composite changes after process: {} {}'.format(before, after)
+    return image.config_hash, composite.config_hash
+
+
+def check_globals_change_hash(cache_dir):
+    global SIZE
+    small = DiskCachedPreprocessor(RGBImageFromArray(image_transformer=resize, name='image'), cache_dir).config_hash
+    SIZE = 224
+    large = DiskCachedPreprocessor(RGBImageFromArray(image_transformer=resize, name='image'), cache_dir).config_hash
+    assert small != large, 'Hash does not change with globals read by transformer'
+
+
+if __name__ == '__main__':
+    cache_dir = tempfile.mkdtemp()
+    if len(sys.argv) > 1:
+        print(' '.join(config_hashes(cache_dir)))
+        sys.exit(0)
+
+    check_globals_change_hash(cache_dir)
+
+    # hashes are to be the same in interpreters with different hash randomization, so that runs reuse cache
+    outputs = []
+    for seed in ('1', '2'):
+        env = dict(os.environ, PYTHONHASHSEED=seed)
+        outputs.append(subprocess.check_output(
+            [sys.executable, '-m', 'tests.data_iterators.disk_cache_hash_test', 'child'], env=env).decode().strip())
+    print(outputs)
+    assert outputs[0] == outputs[1], 'Config hashes differ across runs'
@@ -0,0 +1,38 @@
+import signal
+
+import numpy as np
+import pandas as pd
+
+from package.data_iterators.iterators.multiprocess_iterator import MultiProcessIterator
+from package.data_iterators.samplers.ohc_balancer import OHCBalancer
+from package.data_iterators.preprocessors.base_preprocessor import BasePreprocessor
+
+
+class FailingReader(BasePreprocessor):
+    """Returns index of sample as array, every 4th sample fails"""
+    def process(self, **kwargs):
+        processed = {}
+        for key, data in kwargs.items():
+            if data % 4 == 3:
+                raise IOError('Cannot read sample {}'.format(data))
+            processed[key] = np.full(self._shape, data, dtype=np.float32)
+        return processed
+
+
+if __name__ == '__main__':
+    # results of failed chunks take slots of shared queue as well, they must not block workers
+    signal.alarm(120)
+    num_samples = 400
+    labels_data = pd.get_dummies(np.zeros(num_samples, dtype=int)).values
+
+    for preallocate in (False, True):
+        for deterministic in (False, True):
+            iter_train = MultiProcessIterator(
+                balancer=OHCBalancer(data=labels_data, raise_on_end=True), data={'data': np.arange(num_samples)},
+                preprocessors={'data': FailingReader(name='data', shape=(16,))}, packers={'data': 'numpy'},
+                batch_size=8, num_processes=3, max_results=8, use_shared=True,
+                preallocate=preallocate, deterministic=deterministic,
+            )
+            samples = np.concatenate([batch[0][:, 0] for batch in iter_train]).astype(int)
+            print(preallocate, deterministic, len(samples))
+            assert sorted(samples) == [idx for idx in range(num_samples) if idx % 4 != 3]
@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+
+import time
+
+from package.data_iterators.iterators.thread_pool_iterator import ThreadPoolIterator
+from package.data_iterators.samplers.ohc_balancer import OHCBalancer
+
+from package.data_iterators.preprocessors.base_preprocessor import SlowZeroArrayReader
+from package.data_iterators.preprocessors.base_preprocessor import IdentityPreprocessor
+from package.routines.data_structure_routines import merge_dicts
+
+if __name__ == '__main__':
+
+    labels_data = np.repeat(np.arange(6), axis=0, repeats=1000)
+    labels_data = pd.get_dummies(labels_data).values.astype(float)
+    balancer = OHCBalancer(data=labels_data, raise_on_end=True)
+
+    data_proc = {
+        'data': SlowZeroArrayReader(name='data', shape=(1000, 1000), dtype=float)
+    }
+
+    label_proc = {
+        'label': IdentityPreprocessor(name='label', shape=(6,))
+    }
+
+    iter_train = ThreadPoolIterator(
+        balancer=balancer, data={'data': labels_data, 'label': labels_data},
+        preprocessors=merge_dicts(data_proc, label_proc),
+        batch_size=32,
+        num_threads=6,
+        max_tasks=50,
+        chunk_size=4,
+    )
+
+    while True:
+        start = time.time()
+        kek = iter_train.next()
+        print(time.time() - start, kek[0].shape, kek[1].shape)